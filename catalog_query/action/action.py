@@ -21,8 +21,17 @@ import string
 import requests
 import pandas
 
-from ..util import obtain_owner_org, package_search, dataset_query, create_output_dir
+from ..util import obtain_owner_org, package_search, dataset_query, create_output_dir, NullOutput
 from ..catalog_query import ActionException
+from ..organizations import get_directory
+from ..snapshot import write_snapshot
+from .. import logs
+
+# timeout (in seconds) of CKAN API requests, so that an unresponsive catalog doesn't block the Action indefinitely:
+API_TIMEOUT = 120
+
+# dataset attributes (from parse_dataset) in output column order:
+DATASET_COLUMNS = ['name', 'dataset_url', 'title', 'organization', 'harvest_object_url', 'waf_location', 'type', 'num_resources', 'num_tags', 'formats', 'bbox']
 
 
 class ActionBase(object):
@@ -45,22 +54,55 @@ class ActionBase(object):
         output file to write errors encountered while running Action
     out: file
         output file for logging purposes
+    session: requests.Session
+        HTTP session used for CKAN API queries (may be shared between Actions to reuse connections)
+    owns_session: bool
+        whether the session was created by the Action (and is closed by close()), rather than passed in
+    api_timeout: int
+        timeout (in seconds) of CKAN API requests (requests.Timeout is raised if exceeded)
+    response_cache: ResponseCache
+        optional cache of CKAN API responses (may be shared between Actions)
+    org_directory: OrganizationDirectory
+        optional organization directory to resolve Org Names with (defaults to the process-wide directory of the catalog)
+    org_cache_file: str
+        optional path of a file to persist the catalog's organization list to (see catalog_query.organizations)
+    write_results: bool
+        whether the Action writes its results to results_filename/errors_filename (results are also returned from run())
+    write_out: bool
+        whether init_out creates the 'out' file (otherwise 'out' discards output)
+    log_file: str
+        path to a file to write the Action's log to (no log file if not passed)
+    arrow_prefix: str
+        optional path prefix to write Arrow IPC snapshots of the flattened dataset and resource tables to (see catalog_query.snapshot)
     """
 
     # def __init__(self, *args, **kwargs):
     def __init__(self, **kwargs):
-        # logging:
+        # logging (to a file only if requested, with one handler per log file shared by the Actions logging to it, written
+        #   by the catalog_query.logs listener thread so that logging doesn't block the Action; the level is set with
+        #   logs.configure):
         m = importlib.import_module(self.__module__)
         self.logger = logging.getLogger(m.__name__)
-        self.logger.setLevel(logging.INFO)
-        log = logging.FileHandler(m.__name__.split(".")[-1] + ".log", mode='w')
-        log.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
-        self.logger.addHandler(log)
+        self.log_handler = None
+        if kwargs.get("log_file") is not None:
+            self.log_handler = logs.add_log_file(kwargs.get("log_file"))
 
 
         # decode parameters:
         self.catalog_api_url = kwargs.get("catalog_api_url")
 
+        # HTTP session and caches, which may be passed in to share them between Actions (eg. 'catalog-query serve'):
+        # (a session created here is owned, and closed by close(), by the Action:)
+        self.owns_session = kwargs.get("session") is None
+        self.session = kwargs.get("session") or requests.Session()
+        self.api_timeout = kwargs.get("api_timeout") or API_TIMEOUT
+        self.response_cache = kwargs.get("response_cache")
+        self.org_directory = kwargs.get("org_directory")
+        self.org_cache_file = kwargs.get("org_cache_file")
+        self.write_results = kwargs.get("write_results", True)
+        self.write_out = kwargs.get("write_out", True)
+        self.arrow_prefix = kwargs.get("arrow")
+
         # the query parameters for this action are all passed in list form in the 'query' parameter arg, and must be decoded:
         # this is a bit of a hack to extract query parameter keys into instance variables to use in the queries
         # expected values are along the lines of:
@@ -77,7 +119,7 @@ class ActionBase(object):
         # note: dicts do not accommodate repeating keys, so may lose repeated param keys passed (eg. res_format:, res_format:)
         # self.query_params was already incorporated in the code, so kept, but should use self.params_list instead
         if len(self.params_list) >= 1:
-            self.query_params = dict(param.split(":") for param in self.params_list)
+            self.query_params = dict(param.split(":", 1) for param in self.params_list)
         else:
             self.query_params = {}
 
@@ -111,34 +153,13 @@ class ActionBase(object):
 
     def obtain_owner_org(self, org_name):
         """
-        obtain_owner_org: return org info from the CKAN API via query by Org Name (self.query_org)
-        obtain the organization id:
-        https://data.ioos.us/api/3/action/organization_list?q=
+        obtain_owner_org: return org info (id, name, display_name, title) by Org Name (case-insensitive) from the catalog's
+        organization directory, which loads the organization list once and falls back to organization_show:
+        https://data.ioos.us/api/3/action/organization_list?all_fields=true
         """
-        action = "organization_list"
-        payload = {'q': org_name, 'all_fields': 'true'}
-        url = ("/").join([self.catalog_api_url, "action", action])
-        if self.logger:
-            self.logger.info("Executing {action}.  URL: {url}. Parameters {params}".format(action=action, url=url, params=payload))
-        r = requests.post(url=url, json=payload)
-
-        result = json.loads(r.text)
-        print(json.dumps(result, indent=4, sort_keys=True))
-
-        # the step to loop through the 'result' array isn't really necessary since we expect the org name
-        # to match what was passed in the query, but it is safer than assuming it will (API may return multiple)
-        for org in result['result']:
-            # could also use org['title'] it seems
-            if org['display_name'] == org_name:
-                org_result = org
-
-        # check to make sure a valid Org name was passed:
-        try:
-            org_result
-        except NameError:
-            raise ActionException("Error: no Organization matching {org} exists in the Catalog.  Please try again (query is case sensitive).".format(org=org_name))
-
-        print("Organization id: {id}".format(id=org_result['id']))
+        directory = self.org_directory or get_directory(self.catalog_api_url, cache_file=self.org_cache_file)
+        org_result = directory.resolve(org_name, session=self.session, timeout=self.api_timeout)
+        logs.event(self.logger, logs.INFO, "organization", name=org_name, id=org_result['id'])
         return org_result
 
 
@@ -157,22 +178,26 @@ class ActionBase(object):
             query = " {} ".format(operator).join(params)
             payload['q'] = query
 
-        print(payload)
         url = ("/").join([self.catalog_api_url, "action", action])
-        if self.logger:
-            self.logger.info("Executing {action}.  URL: {url}. Parameters {params}".format(action=action, url=url, params=payload))
+        if self.response_cache is not None:
+            result = self.response_cache.get(url, payload)
+            if result is not None:
+                return result
+
+        logs.event(self.logger, logs.DEBUG, action, url=url, params=payload)
         #r = requests.get(url=url, headers = {'content-type': 'application/json'}, params=payload)
         #r = requests.post(url=url, headers = {'content-type': 'application/json'}, data=json.dumps(payload))
-        r = requests.post(url=url, headers = {'content-type': 'application/json'}, json=payload)
+        r = self.session.post(url=url, headers = {'content-type': 'application/json'}, json=payload, timeout=self.api_timeout)
 
         # either works:
         #result = json.loads(r.text)
         result = r.json()
+        if self.response_cache is not None:
+            self.response_cache.put(url, payload, result)
 
         # this is the full package_search result:
-        #print(r.text)
-        #if out:
-        #    out.write(json.dumps(result, indent=4, sort_keys=True, ensure_ascii=False))
+        if self.logger.isEnabledFor(logs.TRACE):
+            logs.event(self.logger, logs.TRACE, "package_search_result", url=url, params=payload, response=r.text)
         return result
 
 
@@ -180,17 +205,23 @@ class ActionBase(object):
         """
         Wrapper function that queries CKAN package_search API endpoint via package_search function and collects results into list
         """
+        return [{'id': package['id'], 'package': package} for package in self.iter_packages(org_id=org_id, params=params, operator=operator, rows=rows)]
+
+
+    def iter_packages(self, org_id=None, params=None, operator=None, rows=100):
+        """
+        Generator that queries CKAN package_search API endpoint via package_search function page by page and yields each package
+        """
 
         count = 0
-        dataset_results = []
         while True:
             package_results = self.package_search(org_id=org_id, params=params, operator=operator, start_index=count, rows=rows)
             # obtain the total result count to iterate if necessary:
             result_count = package_results['result']['count']
             if count == 0:
-                print("result_count: " + str(result_count))
+                logs.event(self.logger, logs.INFO, "result_count", count=result_count)
 
-            # here we just append to dataset_results a nested dict with package['id'] and package JSON string
+            # here we just yield each package JSON dict
             for package in package_results['result']['results']:
                 count += 1
                 #print(package)
@@ -213,15 +244,11 @@ class ActionBase(object):
                             resource_results.append(resource)
                 """
 
-                dataset_results.append({
-                    'id': package['id'],
-                    'package': package
-                })
-            if count == result_count:
+                yield package
+            # stop at the end of the results (or if the result set shrinks while paging):
+            if count >= result_count or not package_results['result']['results']:
                 break
 
-        return dataset_results
-
 
     def parse_dataset_results(self, results):
         """
@@ -230,76 +257,81 @@ class ActionBase(object):
 
         # handle results (list of dicts):
         # [{'id': 'package_id', 'package': 'package_json'},]
-        datasets = []
-        for result in results:
-            #print("id: {id}".format(id=result['id']))
-            #print("package: {package}".format(package=result['package']))
-
-            # for this action, we just want to extract some attributes of the dataset and dump to .csv:
-            # ['id']: dataset id
-            # ['name']: used to contstruct a URL
-            # ['dataset_url']: CKAN catalog URL for the dataset (contstructed from 'name')
-            # ['title']: the real 'name'
-            # ['harvest_object_url']: CKAN harvest object URL (stored ISO XML)
-            # ['waf_location']: URL to the orignal harvested XML file
-            # ['type']: usually 'dataset', but whatever
-            # ['num_resources']: number of associated resources
-            # ['num_tags']: number of associated tags
-            # ['bbox']: the bounding box JSON (extracted from an 'extra' of the dataset with key='spatial')
-            # ['resources']['format']: resource format
-            # ['organization']['title']: the dataset's organization title
-            parsed_url = urlparse(self.catalog_api_url, allow_fragments=False)
-            try:
-                bbox = [extra['value'] for extra in result['package']['extras'] if extra['key'] == "spatial"][0]
-            except IndexError:
-                bbox = ""
-            try:
-                harvest_object_id = [extra['value'] for extra in result['package']['extras'] if extra['key'] == "harvest_object_id"][0]
-                harvest_object_url = "{scheme}://{netloc}/harvest/object/{id}".format(scheme=parsed_url.scheme, netloc=parsed_url.netloc, id=harvest_object_id)
-            except IndexError:
-                harvest_object_url = ""
-            try:
-                waf_location = [extra['value'] for extra in result['package']['extras'] if extra['key'] == "waf_location"][0]
-            except IndexError:
-                waf_location = ""
-            dataset_url = "{scheme}://{netloc}/dataset/{name}".format(scheme=parsed_url.scheme, netloc=parsed_url.netloc, name=result['package']['name'])
-            # necessary to quote ("") any fields that may have commas or semicolons for CSV output:
-            if any(x in result['package']['title'] for x in [",",";"]):
-                title = "\"{title}\"".format(title=result['package']['title'])
-            else:
-                title = result['package']['title']
-            resource_formats = [resource['format'] for resource in result['package']['resources']]
-            #formats_list = "\"{list}\"".format(list=",".join(resource_formats))
-            formats_list = "-".join(resource_formats)
-            organization = result['package']['organization']['title']
-            datasets.append({
-                'id': result['package']['id'],
-                'name': result['package']['name'],
-                'dataset_url': dataset_url,
-                'title': title,
-                'organization': organization,
-                'harvest_object_url': harvest_object_url,
-                'waf_location': waf_location,
-                'type': result['package']['type'],
-                'num_resources': result['package']['num_resources'],
-                'num_tags': result['package']['num_tags'],
-                'formats': formats_list,
-                'bbox': bbox
-            })
-
-        # do something with results:
+        datasets = [self.parse_dataset(result['package']) for result in results]
+
+        # do something with results (each parsed dataset is logged at TRACE level only):
         for dataset in datasets:
-            self.out.write(json.dumps(dataset, indent=2, sort_keys=True, ensure_ascii=False))
+            logs.event(self.logger, logs.TRACE, "dataset", sample=True, id=dataset['id'], record=dataset)
 
         if "name" in self.query_params.keys():
-            print("Found {count} packages belonging to {org} from {action} query action".format(count=len(datasets), org=self.query_params.get("name"), action=self.action_name))
-            self.out.write(u"\nFound {count} packages belonging to {org} from {action} query action".format(count=len(datasets), org=self.query_params.get("name"), action=self.action_name))
+            self.summary("Found {count} packages belonging to {org} from {action} query action".format(count=len(datasets), org=self.query_params.get("name"), action=self.action_name))
         else:
-            print("Found {count} packages from {action} query action".format(count=len(datasets), action=self.action_name))
-            self.out.write(u"\nFound {count} packages from {action} query action".format(count=len(datasets), action=self.action_name))
+            self.summary("Found {count} packages from {action} query action".format(count=len(datasets), action=self.action_name))
 
         return datasets
 
+    def parse_dataset(self, package):
+        """
+        flatten a CKAN package into a dict of the dataset attributes used in output
+        """
+        # for this action, we just want to extract some attributes of the dataset and dump to .csv:
+        # ['id']: dataset id
+        # ['name']: used to contstruct a URL
+        # ['dataset_url']: CKAN catalog URL for the dataset (contstructed from 'name')
+        # ['title']: the real 'name'
+        # ['harvest_object_url']: CKAN harvest object URL (stored ISO XML)
+        # ['waf_location']: URL to the orignal harvested XML file
+        # ['harvest_source_title']: title of the harvest source the dataset was harvested from (not in the .csv output)
+        # ['type']: usually 'dataset', but whatever
+        # ['num_resources']: number of associated resources
+        # ['num_tags']: number of associated tags
+        # ['bbox']: the bounding box JSON (extracted from an 'extra' of the dataset with key='spatial')
+        # ['resources']['format']: resource format
+        # ['organization']['title']: the dataset's organization title
+        parsed_url = urlparse(self.catalog_api_url, allow_fragments=False)
+        try:
+            bbox = [extra['value'] for extra in package['extras'] if extra['key'] == "spatial"][0]
+        except IndexError:
+            bbox = ""
+        try:
+            harvest_object_id = [extra['value'] for extra in package['extras'] if extra['key'] == "harvest_object_id"][0]
+            harvest_object_url = "{scheme}://{netloc}/harvest/object/{id}".format(scheme=parsed_url.scheme, netloc=parsed_url.netloc, id=harvest_object_id)
+        except IndexError:
+            harvest_object_url = ""
+        try:
+            waf_location = [extra['value'] for extra in package['extras'] if extra['key'] == "waf_location"][0]
+        except IndexError:
+            waf_location = ""
+        try:
+            harvest_source_title = [extra['value'] for extra in package['extras'] if extra['key'] == "harvest_source_title"][0]
+        except IndexError:
+            harvest_source_title = ""
+        dataset_url = "{scheme}://{netloc}/dataset/{name}".format(scheme=parsed_url.scheme, netloc=parsed_url.netloc, name=package['name'])
+        # necessary to quote ("") any fields that may have commas or semicolons for CSV output:
+        if any(x in package['title'] for x in [",",";"]):
+            title = "\"{title}\"".format(title=package['title'])
+        else:
+            title = package['title']
+        resource_formats = [resource['format'] for resource in package['resources']]
+        #formats_list = "\"{list}\"".format(list=",".join(resource_formats))
+        formats_list = "-".join(resource_formats)
+        organization = package['organization']['title']
+        return {
+            'id': package['id'],
+            'name': package['name'],
+            'dataset_url': dataset_url,
+            'title': title,
+            'organization': organization,
+            'harvest_object_url': harvest_object_url,
+            'waf_location': waf_location,
+            'harvest_source_title': harvest_source_title,
+            'type': package['type'],
+            'num_resources': package['num_resources'],
+            'num_tags': package['num_tags'],
+            'formats': formats_list,
+            'bbox': bbox
+        }
+
     def write_dataset_results_to_csv(self, datasets):
         """
         write dataset list to self.results_filename
@@ -311,13 +343,30 @@ class ActionBase(object):
         #    pass
 
         # datasets_df.to_csv(self.results_filename, encoding='utf-8')
-        datasets_df.reindex(columns=['name', 'dataset_url', 'title', 'organization', 'harvest_object_url', 'waf_location', 'type', 'num_resources', 'num_tags','formats','bbox']).to_csv(self.results_filename, encoding='utf-8')
+        datasets_df.reindex(columns=DATASET_COLUMNS).to_csv(self.results_filename, encoding='utf-8')
 
 
+    def write_arrow_snapshot(self, results, datasets=None):
+        """
+        write Arrow IPC snapshots of the flattened dataset and resource tables of the results to self.arrow_prefix (if set)
+        """
+        if self.arrow_prefix is None:
+            return
+        packages = [result['package'] for result in results]
+        if datasets is None:
+            datasets = [self.parse_dataset(package) for package in packages]
+        if os.path.dirname(self.arrow_prefix) and not os.path.exists(os.path.dirname(self.arrow_prefix)):
+            create_output_dir(os.path.dirname(self.arrow_prefix))
+        paths = write_snapshot(self.arrow_prefix, datasets, packages)
+        self.summary("Wrote Arrow snapshot files: {}".format(", ".join(paths.values())))
+
     def init_out(self, subdir=None):
         """
         init_out: create output file for general logging (create file if not already existing, including subdir if provided):
         """
+        if not self.write_out:
+            self.out = NullOutput()
+            return
         if subdir is not None:
             filename = os.path.join(subdir, self.action_name + ".out")
         else:
@@ -327,3 +376,24 @@ class ActionBase(object):
             create_output_dir(os.path.dirname(filename))
         self.out = io.open(filename, mode="wt", encoding="utf-8")
         #print(filename)
+
+    def summary(self, msg):
+        """
+        summary: report a summary line of the Action's progress or results (written to self.out and logged at INFO, which
+        the command line writes to the console)
+        """
+        self.out.write(u"\n" + msg)
+        self.logger.info(msg)
+
+    def close(self):
+        """
+        close: release the output file, log handler and HTTP session opened by this Action (for long-running processes that
+        create many Actions)
+        """
+        if getattr(self, "out", None) is not None:
+            self.out.close()
+        if self.owns_session:
+            self.session.close()
+        if self.log_handler is not None:
+            logs.remove_log_file(self.log_handler)
+            self.log_handler = None
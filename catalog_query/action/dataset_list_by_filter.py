@@ -38,4 +38,6 @@ class Action(ActionBase):
 
         #handle output:
         datasets = self.parse_dataset_results(results)
-        if len(datasets) > 0: self.write_dataset_results_to_csv(datasets)
+        if len(datasets) > 0 and self.write_results: self.write_dataset_results_to_csv(datasets)
+        self.write_arrow_snapshot(results, datasets)
+        return datasets
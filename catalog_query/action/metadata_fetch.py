@@ -0,0 +1,167 @@
+"""
+metadata_fetch Action: download the ISO XML metadata documents (CKAN harvest objects and original WAF source XML) of the
+datasets matching the filter criteria passed, into content-addressed compressed storage with a manifest .csv file.
+"""
+import gzip
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import pandas
+import requests
+
+# local:
+from .action import ActionBase
+from ..util import create_output_dir, make_session
+from ..catalog_query import ActionException
+from .. import logs
+
+# default number of concurrent downloads and per-request timeout (seconds):
+WORKERS = 8
+TIMEOUT = 60
+
+# dataset attributes (from parse_dataset_results) holding the URLs of metadata documents to fetch:
+SOURCES = ['harvest_object_url', 'waf_location']
+
+MANIFEST_COLUMNS = ['id', 'source', 'url', 'status', 'http_status', 'sha256', 'path', 'bytes', 'etag', 'last_modified', 'fetched', 'error']
+
+
+class Action(ActionBase):
+    """
+    metadata_fetch Action:
+
+    Download the harvest object (ISO XML stored by CKAN) and WAF source XML documents of CKAN datasets that match the filter criteria passed, with bounded parallelism (-w|--workers).
+
+    Documents are stored gzipped under a subdirectory 'metadata_store' next to the manifest (results) file, named by the SHA-256 hash of their content.  The manifest .csv file lists each document's URL, status, hash, stored path and HTTP validators (ETag/Last-Modified).  If the manifest file already exists (pass the same -o|--output on re-runs), conditional GETs are sent so only changed documents are transferred.
+    """
+
+    # def __init__(self, *args, **kwargs):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        # decode parameters:
+        self.workers = kwargs.get("workers") or WORKERS
+        self.timeout = kwargs.get("timeout") or TIMEOUT
+        self.store_dir = kwargs.get("store_dir") or os.path.join(os.path.dirname(os.path.abspath(self.results_filename)), "metadata_store")
+
+        # size the HTTP connection pool to the number of concurrent downloads (unless a shared session was passed):
+        if kwargs.get("session") is None:
+            self.session.close()
+            self.session = make_session(self.workers)
+
+        # call init_out:
+        self.init_out()
+
+    def run(self):
+        """
+        Run the CKAN API queries, then fetch the metadata documents of each dataset concurrently and write the manifest
+        # packages API query:
+        # https://data.ioos.us/api/3/action/package_search?q=owner_org:e596892f-bf26-4020-addc-f60b78a39f41
+        """
+
+        # query packages based on self.params_list list:
+        results = self.dataset_query(params=self.params_list, operator=self.operator)
+        datasets = self.parse_dataset_results(results)
+        self.write_arrow_snapshot(results, datasets)
+
+        # the previous manifest (if any) provides validators for conditional GETs, by URL:
+        previous = self.read_manifest()
+
+        documents = [(dataset['id'], source, dataset[source]) for dataset in datasets for source in SOURCES if dataset[source]]
+        self.summary("Fetching {count} metadata documents with {workers} workers".format(count=len(documents), workers=self.workers))
+
+        manifest = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.fetch, dataset_id, source, url, previous.get(url)) for dataset_id, source, url in documents]
+            for future in as_completed(futures):
+                row = future.result()
+                logs.event(self.logger, logs.DEBUG, "document_fetched", sample=True, url=row['url'], status=row['status'], http_status=row.get('http_status'))
+                manifest.append(row)
+
+        counts = pandas.Series([row['status'] for row in manifest]).value_counts().to_dict() if manifest else {}
+        self.summary("Fetch results: {counts}".format(counts=counts))
+
+        if manifest and self.write_results:
+            self.summary("Writing manifest to csv file: {}".format(self.results_filename))
+            pandas.DataFrame.from_records(manifest, columns=MANIFEST_COLUMNS).sort_values(['id', 'source']).to_csv(self.results_filename, index=False, encoding='utf-8')
+        return manifest
+
+    def read_manifest(self):
+        """
+        read the manifest .csv file from a previous run (if present) into a dict of rows by URL
+        """
+        if not os.path.exists(self.results_filename):
+            return {}
+        manifest_df = pandas.read_csv(self.results_filename, dtype=str, keep_default_na=False)
+        return dict((row['url'], row) for row in manifest_df.to_dict(orient='records'))
+
+    def store_path(self, sha256):
+        """
+        path of a stored (gzipped) document, by its content hash
+        """
+        return os.path.join(self.store_dir, sha256[:2], sha256 + ".xml.gz")
+
+    def fetch(self, dataset_id, source, url, previous=None):
+        """
+        fetch a single metadata document, conditionally if it was stored by a previous run, and return its manifest row
+        """
+        row = dict((column, "") for column in MANIFEST_COLUMNS)
+        row.update({'id': dataset_id, 'source': source, 'url': url, 'fetched': datetime.utcnow().isoformat()})
+
+        # only send validators if the previously fetched document is still in the store:
+        headers = {}
+        if previous and previous.get('sha256') and os.path.exists(self.store_path(previous['sha256'])):
+            if previous.get('etag'):
+                headers['If-None-Match'] = previous['etag']
+            if previous.get('last_modified'):
+                headers['If-Modified-Since'] = previous['last_modified']
+
+        try:
+            r = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            row.update({'status': 'error', 'error': str(e)})
+            return row
+
+        row['http_status'] = r.status_code
+        if r.status_code == 304 and headers:
+            for column in ['sha256', 'path', 'bytes', 'etag', 'last_modified']:
+                row[column] = previous[column]
+            row['status'] = 'not_modified'
+            return row
+        if not r.ok:
+            row.update({'status': 'error', 'error': r.reason})
+            return row
+
+        content = r.content
+        sha256 = hashlib.sha256(content).hexdigest()
+        path = self.store_path(sha256)
+        if not os.path.exists(path):
+            self.store(path, content)
+
+        if not previous or not previous.get('sha256'):
+            row['status'] = 'new'
+        elif previous['sha256'] != sha256:
+            row['status'] = 'changed'
+        else:
+            row['status'] = 'unchanged'
+        row.update({
+            'sha256': sha256,
+            'path': path,
+            'bytes': len(content),
+            'etag': r.headers.get('ETag', ""),
+            'last_modified': r.headers.get('Last-Modified', ""),
+        })
+        return row
+
+    def store(self, path, content):
+        """
+        write a document to the store (via a temporary file, so concurrent writers and readers never see a partial file)
+        """
+        if not os.path.exists(os.path.dirname(path)):
+            create_output_dir(os.path.dirname(path))
+        tmp_path = "{path}.{pid}.{thread}.tmp".format(path=path, pid=os.getpid(), thread=threading.current_thread().ident)
+        with gzip.open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
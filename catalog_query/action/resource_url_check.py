@@ -0,0 +1,136 @@
+"""
+resource_url_check Action: check the availability of every resource URL of the datasets matching the filter criteria
+passed, concurrently, and write status, latency, redirect chain and content type to a .csv file.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+try:
+    from urllib.parse import urlsplit  # Python 3
+except ImportError:
+    from urlparse import urlsplit  # Python 2
+
+import pandas
+import requests
+
+# local:
+from .action import ActionBase
+from ..resource_index import ResourceIndex
+from ..util import HostLimiter, make_session
+from ..catalog_query import ActionException
+from .. import logs
+
+# default number of concurrent checks, concurrent checks per host, and per-request timeout (seconds):
+WORKERS = 64
+PER_HOST = 4
+TIMEOUT = 20
+
+RESULT_COLUMNS = ['url', 'host', 'status', 'http_status', 'method', 'latency_ms', 'content_type', 'final_url', 'redirects', 'error', 'checked', 'num_packages', 'package_ids']
+
+
+class Action(ActionBase):
+    """
+    resource_url_check Action:
+
+    Check whether the resource URLs of CKAN datasets that match the filter criteria passed are available.  Each unique (normalized) URL is checked once with a HEAD request, falling back to a ranged GET (first byte only) for servers that reject HEAD requests, and the result applies to all datasets referencing the URL.
+
+    Checks run concurrently (-w|--workers), with at most --per_host concurrent checks against any one host and a per-request timeout (--timeout).  Output .csv file contains one row per URL: status ('ok', 'dead' or 'error'), HTTP status code, latency, redirect chain, content type and the ids of the datasets referencing it.
+    """
+
+    # def __init__(self, *args, **kwargs):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        # decode parameters:
+        self.workers = kwargs.get("workers") or WORKERS
+        self.timeout = kwargs.get("timeout") or TIMEOUT
+        self.host_limiter = HostLimiter(kwargs.get("per_host") or PER_HOST)
+
+        # size the HTTP connection pool to the number of concurrent checks (unless a shared session was passed):
+        if kwargs.get("session") is None:
+            self.session.close()
+            self.session = make_session(self.workers)
+
+        # call init_out:
+        self.init_out()
+
+    def run(self):
+        """
+        Run the CKAN API queries, then check each unique resource URL concurrently and write results
+        # packages API query:
+        # https://data.ioos.us/api/3/action/package_search?q=owner_org:e596892f-bf26-4020-addc-f60b78a39f41
+        """
+
+        # query packages based on self.params_list list:
+        results = self.dataset_query(params=self.params_list, operator=self.operator)
+        self.write_arrow_snapshot(results)
+
+        # index all resources of the packages; each normalized URL is checked once:
+        index = ResourceIndex.from_results(results)
+        urls = self.interleave_hosts(index)
+        self.summary("Checking {count} unique resource URLs of {packages} packages with {workers} workers".format(count=len(urls), packages=len(results), workers=self.workers))
+
+        checks = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = dict((executor.submit(self.check_url, index.entries[key]['url'], index.entries[key]['host']), key) for key in urls)
+            for future in as_completed(futures):
+                check = future.result()
+                package_ids = index.package_ids(futures[future])
+                check['num_packages'] = len(package_ids)
+                check['package_ids'] = ",".join(package_ids)
+                logs.event(self.logger, logs.DEBUG, "url_checked", sample=True, url=check['url'], status=check['status'], http_status=check.get('http_status'), latency_ms=check['latency_ms'])
+                checks.append(check)
+
+        counts = pandas.Series([check['status'] for check in checks]).value_counts().to_dict() if checks else {}
+        self.summary("URL check results: {counts}".format(counts=counts))
+
+        if checks and self.write_results:
+            self.summary("Writing URL check results to csv file: {}".format(self.results_filename))
+            pandas.DataFrame.from_records(checks, columns=RESULT_COLUMNS).sort_values(['host', 'url']).to_csv(self.results_filename, index=False, encoding='utf-8')
+        return checks
+
+    def interleave_hosts(self, index):
+        """
+        order the index's URLs round-robin by host, so that workers aren't all blocked waiting on a single host's cap
+        """
+        by_host = [sorted(keys) for host, keys in sorted(index.by_host.items())]
+        urls = []
+        for i in range(max([len(keys) for keys in by_host] or [0])):
+            urls.extend(keys[i] for keys in by_host if i < len(keys))
+        return urls
+
+    def check_url(self, url, host):
+        """
+        check a single URL: HEAD request, falling back to a ranged GET if the HEAD request is rejected
+        """
+        check = {'url': url, 'host': host, 'checked': datetime.utcnow().isoformat()}
+        # URLs that can't be parsed (eg. an invalid port or IPv6 host) are reported, not requested:
+        try:
+            urlsplit(url).port
+        except ValueError as e:
+            check.update({'status': 'error', 'error': "Invalid URL: {}".format(e), 'latency_ms': 0})
+            return check
+
+        with self.host_limiter.semaphore(host):
+            start = time.time()
+            try:
+                check['method'] = 'HEAD'
+                r = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+                if r.status_code >= 400:
+                    check['method'] = 'GET'
+                    r = self.session.get(url, headers={'Range': 'bytes=0-0'}, allow_redirects=True, stream=True, timeout=self.timeout)
+                    r.close()
+            except (requests.RequestException, ValueError) as e:
+                check.update({'status': 'error', 'error': str(e), 'latency_ms': int((time.time() - start) * 1000)})
+                return check
+
+        check.update({
+            'status': 'ok' if r.status_code < 400 else 'dead',
+            'http_status': r.status_code,
+            'latency_ms': int((time.time() - start) * 1000),
+            'content_type': r.headers.get('Content-Type', ""),
+            'final_url': r.url,
+            'redirects': " -> ".join([response.url for response in r.history] + [r.url]) if r.history else "",
+            'error': "" if r.status_code < 400 else r.reason,
+        })
+        return check
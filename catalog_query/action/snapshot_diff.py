@@ -0,0 +1,201 @@
+"""
+snapshot_diff Action: compare two catalog snapshots (.csv files written by earlier runs, eg. by dataset_list or
+dataset_list_by_filter, or the dataset and resource .arrow files written with --arrow) and report the records that were
+added, removed or modified, without loading either snapshot fully into memory.
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+
+# local:
+from .action import ActionBase
+from ..resource_index import normalize_url
+from ..snapshot import record_reader
+from ..util import create_output_dir
+from ..catalog_query import ActionException
+
+# default key column(s) ('+'-separated for a composite key), default key of resource snapshots, and number of hash partitions:
+KEY = 'id'
+RESOURCE_KEY = 'package_id+id'
+PARTITIONS = 64
+
+# maximum number of hash partitions (a partition file of each is open at once while a snapshot is split):
+MAX_PARTITIONS = 512
+
+# key columns holding URLs, compared in normalized form (see catalog_query.resource_index.normalize_url):
+URL_KEYS = ['url']
+
+# change types reported:
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+# a key occurring more than once in a snapshot (the 'changed_columns' column names the snapshot: 'old' or 'new'):
+DUPLICATE = 'duplicate'
+
+# allow large fields (eg. long resource lists or descriptions):
+csv.field_size_limit(min(sys.maxsize, 2**31 - 1))
+
+
+def partition_of(key, partitions):
+    """
+    stable hash partition number of a record key
+    """
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16) % partitions
+
+
+def fingerprint(record):
+    """
+    content fingerprint of a record (dict of column values), independent of column order
+    """
+    return hashlib.sha1(json.dumps(record, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class Action(ActionBase):
+    """
+    snapshot_diff Action:
+
+    Compare two snapshot .csv files and output one row per added, removed or modified record (with the names of modified columns) in .csv format.
+
+    Requires the paths of the two snapshots as query parameters (-q|--query_params): 'old' and 'new' (eg. -q=old:nanoos_dataset_list_2018.csv,new:nanoos_dataset_list_2019.csv).  Snapshots are .csv files, or .arrow files written with --arrow (which requires pyarrow).  Optional query parameters: 'key', the column(s) identifying records, '+'-separated for a composite key (default: 'id', or 'package_id+id' for resource snapshots, '<prefix>.resources.arrow'), and 'partitions', the number of hash partitions (1 to 512, default: 64).  Resources can also be keyed by dataset and normalized URL with key:package_id+url.
+
+    Both snapshots are split into hash partitions by key in a temporary directory, recording a content fingerprint per record, and compared one partition at a time, so memory use is bounded by the size of one partition rather than of the snapshots.  Keys occurring more than once in a snapshot are reported as 'duplicate' (the first occurrence is compared).
+    """
+
+    # def __init__(self, *args, **kwargs):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        # decode parameters:
+        for param in ['old', 'new']:
+            if param not in self.query_params.keys():
+                raise ActionException("Error running the '{}' action.  No '{}' parameter (path to a snapshot .csv file) provided as a query parameter.  This is required for this action.".format(self.action_name, param))
+            if not os.path.exists(self.query_params[param]):
+                raise ActionException("Error running the '{}' action.  Snapshot file '{}' does not exist.".format(self.action_name, self.query_params[param]))
+        default_key = RESOURCE_KEY if self.query_params['new'].endswith(".resources.arrow") else KEY
+        self.key = self.query_params.get("key", default_key)
+        self.key_columns = self.key.split("+")
+        try:
+            self.partitions = int(self.query_params.get("partitions", PARTITIONS))
+        except ValueError:
+            self.partitions = None
+        if self.partitions is None or not 1 <= self.partitions <= MAX_PARTITIONS:
+            raise ActionException("Error running the '{}' action.  The 'partitions' parameter must be a number from 1 to {}.  Value passed: {}".format(self.action_name, MAX_PARTITIONS, self.query_params.get("partitions")))
+
+        # call init_out:
+        self.init_out()
+
+    def run(self):
+        """
+        Partition both snapshots, then compare them partition by partition and write the differences
+        """
+        counts = {ADDED: 0, REMOVED: 0, MODIFIED: 0, DUPLICATE: 0}
+        with tempfile.TemporaryDirectory(prefix="snapshot_diff_") as tmpdir:
+            old_partitions = self.partition(self.query_params['old'], os.path.join(tmpdir, "old"))
+            new_partitions = self.partition(self.query_params['new'], os.path.join(tmpdir, "new"))
+
+            results = None
+            if self.write_results:
+                if os.path.dirname(self.results_filename) and not os.path.exists(os.path.dirname(self.results_filename)):
+                    create_output_dir(os.path.dirname(self.results_filename))
+                results = io.open(self.results_filename, mode="w", encoding="utf-8", newline="")
+            try:
+                writer = csv.writer(results) if results is not None else None
+                if writer is not None:
+                    writer.writerow([self.key, 'change', 'changed_columns'])
+                for old_partition, new_partition in zip(old_partitions, new_partitions):
+                    for key, change, columns in self.diff_partition(old_partition, new_partition):
+                        counts[change] += 1
+                        if writer is not None:
+                            writer.writerow([key, change, ",".join(columns)])
+            finally:
+                if results is not None:
+                    results.close()
+
+        self.summary("Snapshot differences: {added} added, {removed} removed, {modified} modified, {duplicate} duplicate keys".format(**counts))
+        if self.write_results:
+            self.summary("Wrote snapshot differences to csv file: {}".format(self.results_filename))
+        return counts
+
+    def partition(self, filename, prefix):
+        """
+        split a snapshot file into hash partition files of (key, fingerprint, record JSON) rows, return their paths
+        """
+        paths = ["{prefix}_{n}.csv".format(prefix=prefix, n=n) for n in range(self.partitions)]
+        files = [io.open(path, mode="w", encoding="utf-8", newline="") for path in paths]
+        try:
+            writers = [csv.writer(f) for f in files]
+            for record in self.read_snapshot(filename):
+                key = self.record_key(record)
+                writers[partition_of(key, self.partitions)].writerow([key, fingerprint(record), json.dumps(record, ensure_ascii=False)])
+        finally:
+            for f in files:
+                f.close()
+        return paths
+
+    def read_snapshot(self, filename):
+        """
+        iterate the records (dicts) of a snapshot .csv or .arrow file, checking it has the key column(s)
+        """
+        if filename.endswith(".arrow"):
+            columns, records = record_reader(filename)
+            f = None
+        else:
+            f = io.open(filename, mode="r", encoding="utf-8", newline="")
+            records = csv.DictReader(f)
+            columns = records.fieldnames or []
+        try:
+            missing = [column for column in self.key_columns if column not in columns]
+            if missing:
+                raise ActionException("Error running the '{}' action.  Snapshot file '{}' has no '{}' key column.".format(self.action_name, filename, ", ".join(missing)))
+            for record in records:
+                yield record
+        finally:
+            if f is not None:
+                f.close()
+
+    def record_key(self, record):
+        """
+        remove the key column(s) from a record and return its key (composite keys joined with '+')
+        """
+        values = []
+        for column in self.key_columns:
+            value = record.pop(column)
+            value = "" if value is None else str(value)
+            values.append(normalize_url(value) if column in URL_KEYS and value else value)
+        return "+".join(values)
+
+    def diff_partition(self, old_path, new_path):
+        """
+        compare one partition of the old and new snapshots, yield (key, change, changed columns) for each difference
+        """
+        # only the old side of the partition is held in memory (fingerprints plus record JSON), and the new side's keys:
+        old = {}
+        with io.open(old_path, mode="r", encoding="utf-8", newline="") as f:
+            for key, fp, record in csv.reader(f):
+                if key in old:
+                    yield key, DUPLICATE, ['old']
+                    continue
+                old[key] = (fp, record)
+
+        seen = set()
+        with io.open(new_path, mode="r", encoding="utf-8", newline="") as f:
+            for key, fp, record in csv.reader(f):
+                if key in seen:
+                    yield key, DUPLICATE, ['new']
+                    continue
+                seen.add(key)
+                if key not in old:
+                    yield key, ADDED, []
+                    continue
+                old_fp, old_record = old.pop(key)
+                if old_fp != fp:
+                    old_values, new_values = json.loads(old_record), json.loads(record)
+                    columns = sorted(column for column in set(old_values) | set(new_values) if old_values.get(column) != new_values.get(column))
+                    yield key, MODIFIED, columns
+
+        for key in sorted(old):
+            yield key, REMOVED, []
@@ -11,19 +11,95 @@ except ImportError:
     from urlparse import urlparse  # Python 2
 # import requests
 
+from . import logs
+
 
 IOOS_CATALOG_URL = "https://data.ioos.us/api/3"
-VALID_QUERY_ACTIONS = ['resource_cc_check', 'dataset_list', 'dataset_list_by_filter']
+VALID_QUERY_ACTIONS = ['resource_cc_check', 'dataset_list', 'dataset_list_by_filter', 'metadata_fetch', 'resource_url_check', 'snapshot_diff']
 
 
 class ActionException(Exception):
     pass
 
 
+def load_action(query_action):
+    """
+    Import the module for a named query action and return its Action class
+    """
+    try:
+        # try relative importlib import of action_module (Python 2.7?)
+        action_module = importlib.import_module(".{module}".format(module=query_action), package="catalog_query.action")
+        # for a same-level import (no submodule):
+        # action_module = importlib.import_module(".%s" % query_action, package="catalog_query")
+
+    # handle ImportError and instead try absolute module import (catalog_query.action.*) (Python 3?):
+    except (SystemError, ImportError, ModuleNotFoundError) as e:
+        action_module = importlib.import_module("catalog_query.action.{module}".format(module=query_action))
+
+    return action_module.Action
+
+
+def serve(argv):
+    """
+    'catalog-query serve' subcommand: run the local HTTP/JSON service (see catalog_query.server)
+    """
+    from .server import main as serve_main
+    serve_main(argv)
+
+
+def worker(argv):
+    """
+    'catalog-query worker' subcommand: run Compliance Checker work items from a work queue (see catalog_query.worker)
+    """
+    from .worker import worker_main
+    worker_main(argv)
+
+
+def merge(argv):
+    """
+    'catalog-query merge' subcommand: merge a work queue's results into results and errors CSVs (see catalog_query.worker)
+    """
+    from .worker import merge_main
+    merge_main(argv)
+
+
+def federate(args, catalog_api_urls):
+    """
+    run a dataset Action against several catalogs concurrently and merge the results (see catalog_query.federation)
+    """
+    from .federation import Federation, FEDERATED_ACTIONS
+    if args.action not in FEDERATED_ACTIONS:
+        sys.exit("Error: only the {valid} actions can be run against multiple catalogs.  Value passed: {param}".format(valid=", ".join(FEDERATED_ACTIONS), param=args.action))
+
+    print("query action: {action} (federated, {count} catalogs)".format(action=args.action, count=len(catalog_api_urls)))
+    spec = {'log_file': args.action + ".log"}
+    if args.query_params:
+        spec['query'] = args.query_params
+    if args.operator:
+        spec['operator'] = args.operator
+
+    try:
+        federation = Federation(args.action, catalog_api_urls, spec=spec, dedupe=args.dedupe, workers=args.workers, output=args.output, timeout=args.api_timeout)
+        federation.run()
+    except Exception as e:
+        print(e)
+
+
+# subcommands, dispatched by the first command line argument (eg. 'catalog-query serve --port 8080'):
+SUBCOMMANDS = {
+    'serve': serve,
+    'worker': worker,
+    'merge': merge,
+}
+
+
 def main():
     """
     Command line interface
     """
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        return SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+
     kwargs = {
         'description': 'Query the CKAN API from IOOS Catalog (or other) to get stuff.',
         'formatter_class': argparse.RawDescriptionHelpFormatter,
@@ -31,7 +107,7 @@ def main():
     parser = argparse.ArgumentParser(**kwargs)
 
     parser.add_argument('-c', '--catalog_api_url', type=str, default=IOOS_CATALOG_URL,
-                        help='URL of CKAN Catalog to query.  Default: {cat_url}'.format(cat_url=IOOS_CATALOG_URL))
+                        help='URL of CKAN Catalog to query.  Default: {cat_url}.  Several catalog URLs (comma-separated) run the Action against all of them concurrently and merge the results (supported by the \'dataset_list\' and \'dataset_list_by_filter\' Actions).'.format(cat_url=IOOS_CATALOG_URL))
 
     parser.add_argument('-a', '--action', type=str, required=True,
                         help='Name of a defined Action (CKAN query plus any subsequent analysis) to run. Current provided actions: {valid}'.format(valid=", ".join(VALID_QUERY_ACTIONS)))
@@ -51,34 +127,72 @@ def main():
     parser.add_argument('-t', '--cc_tests', type=str, required=False,
                         help='Compliance checker tests to run (by name, comma-separated) (eg \'-t=acdd:1.3,cf:1.6,ioos\')')
 
+    parser.add_argument('--cc_timeout', type=int, required=False,
+                        help='Deadline (in seconds) for each Compliance Checker test of a URL, after which the check is killed and recorded as timed out, for use with the \'resource_cc_check\' Action.  Default: 300')
+
+    parser.add_argument('--host_failure_limit', type=int, required=False,
+                        help='Number of consecutive failed or timed out Compliance Checker tests after which remaining checks of the same host are skipped, for use with the \'resource_cc_check\' Action.  Default: 3')
+
+    parser.add_argument('-wq', '--work_queue', type=str, required=False,
+                        help='Path to a work queue (SQLite file, created if not existing) to enqueue Compliance Checker checks to, instead of running them, for use with the \'resource_cc_check\' Action.  Run the checks with \'catalog-query worker\' and write the results with \'catalog-query merge\'.')
+
+    parser.add_argument('-ri', '--resource_index', type=str, required=False,
+                        help='Path to a file to save the resource index (resources keyed by format, name, host and normalized URL) built from the query results to (gzipped JSON), for use with the \'resource_cc_check\' Action.  An existing index file built from the same catalog and query parameters is reused instead of querying the catalog again (otherwise it is rebuilt).')
+
+    parser.add_argument('-w', '--workers', type=int, required=False,
+                        help='Number of concurrent workers (eg. downloads) to use, for Actions that run concurrently (\'metadata_fetch\', \'resource_url_check\').')
+
+    parser.add_argument('--timeout', type=int, required=False,
+                        help='Timeout (in seconds) for individual HTTP requests, for Actions that fetch external URLs (\'metadata_fetch\', \'resource_url_check\').')
+
+    parser.add_argument('--api_timeout', type=int, required=False,
+                        help='Timeout (in seconds) for CKAN API requests (default: 120).  A catalog not responding in time fails the query (or, when querying several catalogs, is reported as timed out).')
+
+    parser.add_argument('--per_host', type=int, required=False,
+                        help='Maximum number of concurrent requests to any one host, for the \'resource_url_check\' Action.')
+
+    parser.add_argument('--arrow', type=str, required=False,
+                        help='Path prefix to write Arrow IPC snapshots of the queried datasets and resources to (<prefix>.datasets.arrow, <prefix>.resources.arrow), which can be opened zero-copy with catalog_query.snapshot.open_snapshot.  Requires pyarrow.')
+
+    parser.add_argument('--dedupe', type=str, required=False, choices=['waf_location', 'harvest_source'],
+                        help='When querying several catalogs, drop records already found in an earlier-listed catalog: by harvested document URL (\'waf_location\') or by harvest source (\'harvest_source\', all records of a harvest source come from the first catalog that has it).')
+
+    parser.add_argument('-v', '--log_level', type=str, required=False, default='info', choices=['trace', 'debug', 'info', 'warning'],
+                        help='Log level (console and log file): \'info\' logs summary lines only, \'debug\' each CKAN request and checked item, \'trace\' full request payloads, responses and parsed records.  Default: info')
+
+    parser.add_argument('--log_sample', type=int, required=False, default=1,
+                        help='Log only 1 in N of each per-item (eg. per-URL) event, at the debug and trace levels.  Default: 1 (all)')
+
     args = parser.parse_args()
 
-    catalog_api_url = urlparse(args.catalog_api_url)
-    if not catalog_api_url.scheme or not catalog_api_url.netloc:
-        sys.exit("Error: '--catalog_api_url' parameter value must contain a valid URL.  Value passed: {param}".format(param=args.catalog_api_url))
-    if catalog_api_url.params or catalog_api_url.query:
-        sys.exit("Error: '--catalog_api_url' parameter should not contain query parameters ('{query}'). Please include only the service endpoint URL.  Value passed: {param}".format(query=catalog_api_url.query, param=args.catalog_api_url))
+    logs.configure(level=args.log_level, sample_rate=args.log_sample)
+
+    catalog_api_urls = [url.strip() for url in args.catalog_api_url.split(",") if url.strip()]
+    for url in catalog_api_urls:
+        catalog_api_url = urlparse(url)
+        if not catalog_api_url.scheme or not catalog_api_url.netloc:
+            sys.exit("Error: '--catalog_api_url' parameter value must contain a valid URL.  Value passed: {param}".format(param=url))
+        if catalog_api_url.params or catalog_api_url.query:
+            sys.exit("Error: '--catalog_api_url' parameter should not contain query parameters ('{query}'). Please include only the service endpoint URL.  Value passed: {param}".format(query=catalog_api_url.query, param=url))
 
     # check to make sure the 'action' argument passed matches an expected query action type:
     if args.action not in VALID_QUERY_ACTIONS:
         sys.exit("Error: '--action' parameter value must contain a known query action.  Valid query actions: {valid}.  Value passed: {param}".format(valid=", ".join(VALID_QUERY_ACTIONS), param=args.action))
 
+    # several catalogs: federated query (see catalog_query.federation):
+    if len(catalog_api_urls) > 1:
+        return federate(args, catalog_api_urls)
+    if args.dedupe:
+        sys.exit("Error: '--dedupe' applies only when querying several catalogs (comma-separated '--catalog_api_url' values).  Catalogs passed: {count}".format(count=len(catalog_api_urls)))
+
     # perform the query action (if value passed is known):
     for query_action in VALID_QUERY_ACTIONS:
         if args.action == query_action:
             print("query action: " + query_action)
 
-            try:
-                # try relative importlib import of action_module (Python 2.7?)
-                action_module = importlib.import_module(".{module}".format(module=query_action), package="catalog_query.action")
-                # for a same-level import (no submodule):
-                # action_module = importlib.import_module(".%s" % query_action, package="catalog_query")
-
-            # handle ImportError and instead try absolute module import (catalog_query.action.*) (Python 3?):
-            except (SystemError, ImportError, ModuleNotFoundError) as e:
-                action_module = importlib.import_module("catalog_query.action.{module}".format(module=query_action))
-
-            Action = action_module.Action
+            Action = load_action(query_action)
+            # (imported here, as catalog_query.organizations imports this module:)
+            from .organizations import default_cache_file
 
             # import failure attempts:
             # from .action.query_action import Action
@@ -88,9 +202,10 @@ def main():
             # Action = importlib.import_module("..Action.", "action." + query_action)
             # module = __import__(".action." + query_action, globals(), locals(), ['Action'])
 
-            spec = {}
+            spec = {'log_file': query_action + ".log"}
             if args.catalog_api_url:
                 spec['catalog_api_url'] = args.catalog_api_url
+                spec['org_cache_file'] = default_cache_file(args.catalog_api_url)
             if args.output:
                 spec['output'] = args.output
             if args.error_output:
@@ -101,6 +216,24 @@ def main():
                 spec['operator'] = args.operator
             if args.cc_tests:
                 spec['cc_tests'] = args.cc_tests
+            if args.cc_timeout:
+                spec['cc_timeout'] = args.cc_timeout
+            if args.host_failure_limit:
+                spec['host_failure_limit'] = args.host_failure_limit
+            if args.work_queue:
+                spec['queue'] = args.work_queue
+            if args.resource_index:
+                spec['resource_index'] = args.resource_index
+            if args.arrow:
+                spec['arrow'] = args.arrow
+            if args.workers:
+                spec['workers'] = args.workers
+            if args.timeout:
+                spec['timeout'] = args.timeout
+            if args.api_timeout:
+                spec['api_timeout'] = args.api_timeout
+            if args.per_host:
+                spec['per_host'] = args.per_host
 
             try:
                 action = Action(**spec)
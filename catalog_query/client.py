@@ -0,0 +1,96 @@
+"""
+Programmatic API for querying a CKAN catalog from other Python code (eg. notebooks, Airflow tasks):
+
+    from catalog_query.client import CatalogClient
+    client = CatalogClient("https://data.ioos.us/api/3")
+    for dataset in client.datasets("res_format:OPeNDAP", org="NANOOS"):
+        ...
+    df = client.datasets_df({'res_format': 'OPeNDAP'})
+
+Unlike the command line Actions, a CatalogClient creates no files (output, log or otherwise) unless asked to, and may be
+created and used any number of times in one process.
+"""
+import pandas
+
+from .action.action import ActionBase, DATASET_COLUMNS
+from .catalog_query import IOOS_CATALOG_URL
+from .util import make_session
+
+
+def filter_params(filter):
+    """
+    convert a filter to a list of CKAN package_search (Solr) query parameters: a comma-separated string
+    (eg. 'res_format:OPeNDAP,tags:waves', as with -q|--query_params), a list of 'key:value' strings, or a dict
+    """
+    if filter is None:
+        return None
+    if isinstance(filter, dict):
+        return ["{key}:{value}".format(key=key, value=value) for key, value in filter.items()]
+    if isinstance(filter, str):
+        return [param for param in filter.split(",") if param]
+    return list(filter)
+
+
+class CatalogClient(object):
+    """
+    Client for a CKAN catalog API, reusing one HTTP session (and optional response cache) across queries
+
+    Attributes
+    ----------
+    catalog_api_url : str
+        URL of CKAN API to submit queries to
+    session: requests.Session
+        HTTP session used for all queries
+    owns_session: bool
+        whether the session was created by the client (and is closed by close()), rather than passed in
+    rows: int
+        number of packages requested per package_search page
+    """
+
+    def __init__(self, catalog_api_url=IOOS_CATALOG_URL, session=None, response_cache=None, rows=100, log_file=None, org_cache_file=None):
+        self.catalog_api_url = catalog_api_url
+        self.owns_session = session is None
+        self.session = session or make_session()
+        self.rows = rows
+        self._action = ActionBase(catalog_api_url=catalog_api_url, session=self.session, response_cache=response_cache,
+                                  org_cache_file=org_cache_file, log_file=log_file, write_out=False, write_results=False)
+
+    def close(self):
+        """
+        release the HTTP session, if created by the client (and log file handler, if any)
+        """
+        self._action.close()
+        if self.owns_session:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def organization(self, org_name):
+        """
+        return the organization info (id, name, display_name, title) for an Org Name (case-insensitive)
+        """
+        return self._action.obtain_owner_org(org_name)
+
+    def packages(self, filter=None, operator="AND", org=None):
+        """
+        iterate the full CKAN package dicts matching the filter (and organization, by Org Name, if passed), page by page
+        """
+        org_id = self.organization(org)['id'] if org is not None else None
+        return self._action.iter_packages(org_id=org_id, params=filter_params(filter), operator=operator, rows=self.rows)
+
+    def datasets(self, filter=None, operator="AND", org=None):
+        """
+        iterate flattened dataset dicts (the dataset_list Action output attributes) matching the filter
+        """
+        for package in self.packages(filter=filter, operator=operator, org=org):
+            yield self._action.parse_dataset(package)
+
+    def datasets_df(self, filter=None, operator="AND", org=None):
+        """
+        return the flattened datasets matching the filter as a DataFrame, indexed by dataset id
+        """
+        return pandas.DataFrame.from_records(list(self.datasets(filter=filter, operator=operator, org=org)), index="id", columns=['id'] + DATASET_COLUMNS)
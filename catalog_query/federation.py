@@ -0,0 +1,176 @@
+"""
+Federated queries: run the same dataset Action query against several CKAN catalogs concurrently (eg. the IOOS Catalog,
+data.gov and regional catalogs), tag each record with its source catalog and merge the results into one .csv file,
+optionally dropping records already found in an earlier catalog.
+"""
+import io
+import logging
+import os
+import random
+import string
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas
+import requests
+
+from . import logs
+from .action.action import API_TIMEOUT, DATASET_COLUMNS
+from .catalog_query import ActionException, load_action
+from .util import make_session, create_output_dir
+
+logger = logging.getLogger(__name__)
+
+# Actions whose results (flattened datasets) can be federated:
+FEDERATED_ACTIONS = ['dataset_list', 'dataset_list_by_filter']
+
+# de-duplication keys: 'waf_location' drops records of a harvested document (WAF URL) already found, 'harvest_source' drops
+#   records of a harvest source (by title) already found in an earlier catalog:
+DEDUPE_KEYS = ['waf_location', 'harvest_source']
+
+# HTTP connection pool size of each catalog's session:
+POOL_SIZE = 4
+
+# merged output columns:
+FEDERATED_COLUMNS = ['catalog', 'id'] + DATASET_COLUMNS + ['harvest_source_title']
+
+
+class Federation(object):
+    """
+    Run one Action against several catalogs and merge the results
+
+    Each catalog is queried by its own Action instance, with its own HTTP session (connection pool of 'pool_size') and
+    organization directory, so catalogs don't share connections.  Each CKAN API request times out after 'timeout' seconds,
+    so an unresponsive catalog is recorded as failed rather than blocking the run (a slow but responsive catalog still
+    delays the output of the catalogs listed after it).  Results
+    are appended to the output file catalog by catalog, in the order the catalogs were listed, as soon as each catalog
+    (and all those listed before it) has finished; with 'dedupe', records found in an earlier-listed catalog win.
+
+    Attributes
+    ----------
+    action_name : str
+        name of the Action to run (one of FEDERATED_ACTIONS)
+    catalog_api_urls : list
+        URLs of the CKAN APIs to query
+    spec: dict
+        Action parameters (as for a single catalog run), 'catalog_api_url' is set per catalog
+    log_file: str
+        path to a file to write the log of all catalogs' Actions to (taken from spec, opened once per run)
+    timeout: int
+        timeout (in seconds) of each CKAN API request
+    dedupe: str
+        de-duplication key (one of DEDUPE_KEYS), or None
+    results_filename: str
+        merged output .csv file
+    errors: dict
+        error message by catalog URL, for catalogs whose query failed
+    """
+
+    def __init__(self, action_name, catalog_api_urls, spec=None, dedupe=None, pool_size=POOL_SIZE, workers=None, output=None, timeout=None):
+        if action_name not in FEDERATED_ACTIONS:
+            raise ActionException("Error: the '{}' action can not be run against multiple catalogs.  Actions supported: {}".format(action_name, ", ".join(FEDERATED_ACTIONS)))
+        if dedupe is not None and dedupe not in DEDUPE_KEYS:
+            raise ActionException("Error: unknown de-duplication key '{}'.  Valid keys: {}".format(dedupe, ", ".join(DEDUPE_KEYS)))
+        self.action_name = action_name
+        self.catalog_api_urls = catalog_api_urls
+        self.spec = dict(spec or {})
+        # (the log file is shared by the catalogs' Actions, so it is opened by run() rather than by each Action:)
+        self.log_file = self.spec.pop('log_file', None)
+        self.timeout = timeout or API_TIMEOUT
+        self.dedupe = dedupe
+        self.pool_size = pool_size
+        self.workers = workers or len(catalog_api_urls)
+        self.errors = {}
+
+        if output is not None:
+            self.results_filename = output
+        else:
+            label = "".join(random.choice(string.ascii_lowercase) for i in range(5))
+            self.results_filename = os.path.join(os.getcwd(), "_".join([action_name, "federated", label]) + ".csv")
+
+    def run_catalog(self, catalog_api_url):
+        """
+        run the Action against one catalog, return its flattened datasets tagged with the catalog URL
+        """
+        # (imported here, as catalog_query.organizations imports catalog_query.catalog_query:)
+        from .organizations import default_cache_file
+
+        spec = dict(self.spec)
+        # per-catalog output files are not written, the merged results are:
+        for key in ['output', 'error_output', 'arrow']:
+            spec.pop(key, None)
+        spec.update({
+            'catalog_api_url': catalog_api_url,
+            'org_cache_file': default_cache_file(catalog_api_url),
+            'session': make_session(self.pool_size),
+            'api_timeout': self.timeout,
+            'write_results': False,
+            'write_out': False,
+        })
+        Action = load_action(self.action_name)
+        action = Action(**spec)
+        try:
+            datasets = action.run()
+        finally:
+            action.close()
+            spec['session'].close()
+        for dataset in datasets:
+            dataset['catalog'] = catalog_api_url
+        return datasets
+
+    def run(self):
+        """
+        query all catalogs concurrently, write the merged results, return a dict of the number of records written by catalog
+        """
+        counts = {}
+        seen = set()
+        header = True
+        if os.path.dirname(self.results_filename) and not os.path.exists(os.path.dirname(self.results_filename)):
+            create_output_dir(os.path.dirname(self.results_filename))
+
+        log_handler = logs.add_log_file(self.log_file) if self.log_file is not None else None
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor, io.open(self.results_filename, mode="w", encoding="utf-8", newline="") as f:
+                futures = [(url, executor.submit(self.run_catalog, url)) for url in self.catalog_api_urls]
+                for url, future in futures:
+                    try:
+                        datasets = future.result()
+                    except requests.Timeout as e:
+                        logger.warning("Timed out querying catalog {url} (no response in {timeout} seconds): {error}".format(url=url, timeout=self.timeout, error=e))
+                        self.errors[url] = "timed out: {}".format(e)
+                        continue
+                    except Exception as e:
+                        logger.warning("Error querying catalog {url}: {error}".format(url=url, error=e))
+                        self.errors[url] = str(e)
+                        continue
+
+                    datasets, keys = self.deduplicate(datasets, seen)
+                    seen.update(keys)
+                    counts[url] = len(datasets)
+                    logger.info("Catalog {url}: {count} datasets".format(url=url, count=len(datasets)))
+                    if datasets:
+                        pandas.DataFrame.from_records(datasets, columns=FEDERATED_COLUMNS).to_csv(f, index=False, header=header)
+                        header = False
+        finally:
+            if log_handler is not None:
+                logs.remove_log_file(log_handler)
+
+        logger.info("Wrote {count} datasets from {catalogs} catalogs to csv file: {filename}".format(count=sum(counts.values()), catalogs=len(counts), filename=self.results_filename))
+        return counts
+
+    def deduplicate(self, datasets, seen):
+        """
+        drop datasets whose de-duplication key was seen in an earlier catalog, return the datasets kept and their keys
+        """
+        if self.dedupe is None:
+            return datasets, set()
+        field = 'waf_location' if self.dedupe == 'waf_location' else 'harvest_source_title'
+        kept, keys = [], set()
+        for dataset in datasets:
+            key = (dataset.get(field) or "").strip().lower()
+            if key and key in seen:
+                continue
+            # a catalog's own records with the same key (eg. all records of a harvest source) are kept:
+            if key:
+                keys.add(key)
+            kept.append(dataset)
+        return kept, keys
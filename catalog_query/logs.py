@@ -0,0 +1,203 @@
+"""
+Logging for catalog-query: leveled, structured events ('event key=value ...') handed to a queue and written by a
+background listener thread, so that writing log output never blocks the threads doing the work.
+
+Levels: summary lines (run totals, output files) are logged at INFO, the default level; per-item events (each CKAN
+request, URL check, fetched document) at DEBUG; full request payloads, response bodies and parsed records at TRACE.
+Per-item events can be sampled (only 1 in 'sample_rate' of each event emitted), to keep verbose logs of large runs small.
+
+    from catalog_query import logs
+    logs.configure(level='debug', sample_rate=100)
+    logs.event(logger, logs.DEBUG, 'url_checked', sample=True, url=url, status=status)
+"""
+import atexit
+import logging
+import os
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# root logger of the package (Action loggers, eg. 'catalog_query.action.dataset_list', are its children):
+LOGGER_NAME = 'catalog_query'
+
+TRACE = 5
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+logging.addLevelName(TRACE, 'TRACE')
+
+LEVELS = {'trace': TRACE, 'debug': DEBUG, 'info': INFO, 'warning': WARNING}
+DEFAULT_LEVEL = 'info'
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s %(message)s'
+
+_lock = threading.Lock()
+_queue_handler = None
+_listener = None
+_sampler = None
+_console = None
+# log file handlers by absolute file name: [handler, number of owners] (a handler whose owners all released it stays
+#   registered, with 0 owners, until the listener removes it):
+_log_files = {}
+
+
+def event(logger, level, event_name, sample=False, **fields):
+    """
+    log a structured event (event name plus key=value fields) if the logger is enabled for the level; fields are
+    formatted by the listener thread.  'sample' marks per-item events subject to sampling.
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, event_name, extra={'event': event_name, 'fields': fields, 'sampled': sample})
+
+
+class EventFormatter(logging.Formatter):
+    """
+    format structured events as 'event key=value ...' (other records as usual)
+    """
+
+    def formatMessage(self, record):
+        fields = getattr(record, 'fields', None)
+        if fields:
+            record.message = " ".join([record.message] + ["{}={}".format(key, value) for key, value in fields.items()])
+        return super().formatMessage(record)
+
+
+class Sampler(logging.Filter):
+    """
+    pass only 1 in 'rate' of the sampled events of each name (all other records pass)
+    """
+
+    def __init__(self, rate=1):
+        super().__init__()
+        self.rate = max(1, int(rate))
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.rate == 1 or not getattr(record, 'sampled', False):
+            return True
+        with self._lock:
+            count = self._counts.get(record.event, 0)
+            self._counts[record.event] = count + 1
+        return count % self.rate == 0
+
+
+class Listener(QueueListener):
+    """
+    queue listener that also removes log file handlers, when it reaches their removal marker in the queue (so the events
+    queued before the removal are still written, without stopping the listener thread)
+    """
+
+    def handle(self, record):
+        handler = getattr(record, 'remove_handler', None)
+        if handler is None:
+            return super().handle(record)
+        with _lock:
+            entry = _log_files.get(handler.baseFilename)
+            # (the file may have been added again since its removal was queued, then it is kept:)
+            if entry is None or entry[0] is not handler or entry[1] > 0:
+                return
+            del _log_files[handler.baseFilename]
+            self.handlers = tuple(h for h in self.handlers if h is not handler)
+        handler.flush()
+        handler.close()
+
+
+def _ensure_listener():
+    """
+    attach the queue handler to the package logger and start the listener thread, once per process
+    """
+    global _queue_handler, _listener, _sampler
+    if _listener is not None:
+        return
+    _sampler = Sampler()
+    _queue_handler = QueueHandler(queue.Queue())
+    _queue_handler.addFilter(_sampler)
+    _listener = Listener(_queue_handler.queue, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.addHandler(_queue_handler)
+    if logger.level == logging.NOTSET:
+        logger.setLevel(LEVELS[DEFAULT_LEVEL])
+
+
+def _set_handlers(handlers):
+    # (the listener thread reads its handler tuple per record, so replacing it is safe while running:)
+    _listener.handlers = tuple(handlers)
+
+
+def configure(level=DEFAULT_LEVEL, sample_rate=1, stream=sys.stderr):
+    """
+    set the package log level (name or number) and sampling rate of per-item events, and log events to 'stream'
+    (in addition to any log files); may be called again to reconfigure
+    """
+    global _console
+    with _lock:
+        _ensure_listener()
+        logger = logging.getLogger(LOGGER_NAME)
+        logger.setLevel(LEVELS.get(level, level) if isinstance(level, str) else level)
+        # records are handled by the listener, not (again) by the root logger's handlers:
+        logger.propagate = False
+        _sampler.rate = max(1, int(sample_rate))
+
+        handlers = [handler for handler in _listener.handlers if handler is not _console]
+        _console = None
+        if stream is not None:
+            _console = logging.StreamHandler(stream)
+            _console.setFormatter(EventFormatter(LOG_FORMAT))
+            handlers.append(_console)
+        _set_handlers(handlers)
+
+
+def add_log_file(filename):
+    """
+    write the package's log events to a file, return its handler, to be released with remove_log_file.  A file is
+    written by one handler, shared (and reference counted) by all callers logging to it.
+    """
+    with _lock:
+        _ensure_listener()
+        entry = _log_files.get(os.path.abspath(filename))
+        if entry is not None:
+            entry[1] += 1
+            return entry[0]
+        handler = logging.FileHandler(filename, mode='w')
+        handler.setFormatter(EventFormatter(LOG_FORMAT))
+        _log_files[handler.baseFilename] = [handler, 1]
+        _set_handlers(list(_listener.handlers) + [handler])
+        return handler
+
+
+def remove_log_file(handler):
+    """
+    release a log file handler returned by add_log_file; once released by all its owners, log events stop being written
+    to the file after the events already queued (the file is closed by the listener thread)
+    """
+    with _lock:
+        entry = _log_files.get(handler.baseFilename)
+        if _listener is None or entry is None or entry[0] is not handler or entry[1] == 0:
+            return
+        entry[1] -= 1
+        if entry[1] == 0:
+            _queue_handler.queue.put_nowait(logging.makeLogRecord({'remove_handler': handler}))
+
+
+def shutdown():
+    """
+    write all queued events and stop the listener thread
+    """
+    global _queue_handler, _listener
+    with _lock:
+        if _listener is None:
+            return
+        listener = _listener
+        logging.getLogger(LOGGER_NAME).removeHandler(_queue_handler)
+        _queue_handler, _listener = None, None
+    # (outside the lock, which the listener thread takes to remove log files still queued for removal:)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.flush()
+    with _lock:
+        _log_files.clear()
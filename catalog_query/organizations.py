@@ -0,0 +1,208 @@
+"""
+Organization directory: resolve CKAN Organization names to organization info (id, name, display name, title) from a
+TTL-bounded, optionally persistent, copy of the catalog's organization list, rather than querying the API on every run
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from . import logs
+from .catalog_query import ActionException
+
+# number of seconds before the organization list is refreshed (organizations rarely change):
+ORG_CACHE_TTL = 24 * 60 * 60
+
+# default directory for persistent organization list caches (one file per catalog):
+ORG_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "catalog_query")
+
+# organization attributes kept in the directory:
+ORG_FIELDS = ['id', 'name', 'display_name', 'title']
+
+# timeout (in seconds) of organization API requests (callers pass their own):
+REQUEST_TIMEOUT = 120
+
+# organization_list page size (CKAN may cap all_fields listings at a lower limit, paging handles either):
+PAGE_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+# directories shared by all users in the process, by catalog URL:
+_directories = {}
+_directories_lock = threading.Lock()
+
+
+def default_cache_file(catalog_api_url):
+    """
+    default persistent cache file path for a catalog
+    """
+    return os.path.join(ORG_CACHE_DIR, "organizations-{}.json".format(hashlib.sha1(catalog_api_url.encode('utf-8')).hexdigest()[:12]))
+
+
+def get_directory(catalog_api_url, cache_file=None, ttl=ORG_CACHE_TTL):
+    """
+    return the process-wide OrganizationDirectory for a catalog, creating it on first use
+    """
+    with _directories_lock:
+        directory = _directories.get(catalog_api_url)
+        if directory is None:
+            directory = _directories[catalog_api_url] = OrganizationDirectory(catalog_api_url, cache_file=cache_file, ttl=ttl)
+        elif cache_file is not None and directory.cache_file is None:
+            directory.cache_file = cache_file
+        return directory
+
+
+class OrganizationDirectory(object):
+    """
+    Case-insensitive directory of a catalog's organizations, by name, display name and title
+
+    The full organization list is loaded once (from the persistent cache file, if passed and fresh, otherwise from the
+    organization_list API) and refreshed in a background thread once older than 'ttl' seconds; stale entries keep being
+    served meanwhile.  Names missing from the directory fall back to a single organization_show query.
+
+    The directory holds no HTTP session, as it outlives the Actions sharing it: API queries use the session of the caller
+    (or a one-off connection if none is passed, as for background refreshes).
+
+    Attributes
+    ----------
+    catalog_api_url : str
+        URL of CKAN API to submit queries to
+    cache_file: str
+        path of a JSON file to persist the organization list to (not persisted if None)
+    ttl: int
+        number of seconds the organization list is considered fresh
+    loaded: float
+        time the organization list was loaded (None if not yet loaded)
+    """
+
+    def __init__(self, catalog_api_url, cache_file=None, ttl=ORG_CACHE_TTL):
+        self.catalog_api_url = catalog_api_url
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.loaded = None
+        self._index = {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._refreshing = None
+
+    def resolve(self, org_name, session=None, timeout=REQUEST_TIMEOUT):
+        """
+        return the organization info matching an Org Name (name, display name or title, case-insensitive)
+        """
+        self._ensure_loaded(session, timeout)
+        org = self._index.get(org_name.strip().lower())
+        if org is None:
+            # (CKAN organization names and ids are lowercase:)
+            org = self.show(org_name.strip().lower(), session=session, timeout=timeout)
+        if org is None:
+            raise ActionException("Error: no Organization matching {org} exists in the Catalog.  Please try again.".format(org=org_name))
+        return org
+
+    def show(self, org_name, session=None, timeout=REQUEST_TIMEOUT):
+        """
+        look up a single organization with organization_show (by name or id) and add it to the directory
+        """
+        url = "/".join([self.catalog_api_url, "action", "organization_show"])
+        logs.event(logger, logs.DEBUG, "organization_show", url=url, id=org_name)
+        r = (session or requests).post(url=url, json={'id': org_name, 'include_datasets': False}, timeout=timeout)
+        try:
+            result = r.json()
+        except ValueError:
+            return None
+        if not result.get('success'):
+            return None
+        org = dict((field, result['result'].get(field)) for field in ORG_FIELDS)
+        with self._lock:
+            self._add(self._index, org)
+        return org
+
+    def refresh(self, session=None, timeout=REQUEST_TIMEOUT):
+        """
+        reload the full organization list from the organization_list API (and persist it, if a cache file is configured)
+        """
+        url = "/".join([self.catalog_api_url, "action", "organization_list"])
+        organizations = []
+        offset = 0
+        while True:
+            payload = {'all_fields': True, 'limit': PAGE_SIZE, 'offset': offset}
+            logs.event(logger, logs.DEBUG, "organization_list", url=url, params=payload)
+            page = (session or requests).post(url=url, json=payload, timeout=timeout).json()['result']
+            # stop at the end of the list (or if the API ignores 'offset' and returns the same page again):
+            if not page or (organizations and page[0].get('id') == organizations[0]['id']):
+                break
+            organizations.extend(dict((field, org.get(field)) for field in ORG_FIELDS) for org in page)
+            offset += len(page)
+
+        self._set(organizations, time.time())
+        if self.cache_file is not None:
+            self._save(organizations)
+        return organizations
+
+    def _ensure_loaded(self, session=None, timeout=REQUEST_TIMEOUT):
+        if self.loaded is None:
+            # only one thread loads the list initially, the others wait for it:
+            with self._load_lock:
+                if self.loaded is None and not self._load():
+                    self.refresh(session, timeout)
+        elif time.time() - self.loaded > self.ttl:
+            self._refresh_in_background()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing is not None and self._refreshing.is_alive():
+                return
+            self._refreshing = threading.Thread(target=self._background_refresh, name="organization-directory-refresh")
+            self._refreshing.daemon = True
+            self._refreshing.start()
+
+    def _background_refresh(self):
+        # (no caller's session here, the caller may close it before the refresh finishes:)
+        try:
+            self.refresh()
+        except Exception as e:
+            # keep serving the stale list, retry on a later lookup:
+            logs.event(logger, logs.WARNING, "organization_list_refresh_failed", url=self.catalog_api_url, error=e)
+
+    @staticmethod
+    def _add(index, org):
+        for key in ['name', 'display_name', 'title', 'id']:
+            if org.get(key):
+                index[org[key].strip().lower()] = org
+
+    def _set(self, organizations, loaded):
+        index = {}
+        for org in organizations:
+            self._add(index, org)
+        with self._lock:
+            self._index = index
+            self.loaded = loaded
+
+    def _load(self):
+        """
+        load the organization list from the cache file, if present, for this catalog and still fresh
+        """
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return False
+        # (an unreadable or truncated cache file is refetched:)
+        try:
+            with open(self.cache_file) as f:
+                cached = json.load(f)
+        except (ValueError, OSError, EOFError):
+            return False
+        if cached.get('catalog_api_url') != self.catalog_api_url or time.time() - cached.get('loaded', 0) > self.ttl:
+            return False
+        self._set(cached['organizations'], cached['loaded'])
+        return True
+
+    def _save(self, organizations):
+        cache_dir = os.path.dirname(self.cache_file)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = "{}.{}.tmp".format(self.cache_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            json.dump({'catalog_api_url': self.catalog_api_url, 'loaded': self.loaded, 'organizations': organizations}, f)
+        os.replace(tmp_file, self.cache_file)
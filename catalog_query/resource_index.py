@@ -0,0 +1,173 @@
+"""
+In-memory (and persistable) index of CKAN Resources keyed by format, name, URL host and normalized URL
+
+Resources of several packages frequently point at the same service endpoint.  The index collapses those onto a single
+normalized URL, so an Action can check each endpoint once and fan the result out to every package referencing it.
+"""
+import gzip
+import json
+try:
+    from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode   # Python 3
+except ImportError:
+    from urlparse import urlsplit, urlunsplit, parse_qsl  # Python 2
+    from urllib import urlencode
+
+# default ports dropped from normalized URLs:
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    """
+    normalize_url: return a canonical form of a resource URL, used to detect resources pointing at the same endpoint
+    (lowercase scheme and host, default port and fragment removed, query parameters sorted, trailing '/' removed).
+    URLs that can't be parsed (eg. an invalid port or IPv6 host) are returned stripped but otherwise unchanged.
+    """
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url.strip()
+    scheme = parts.scheme.lower()
+    netloc = parts.hostname or ""
+    if port and port != DEFAULT_PORTS.get(scheme):
+        netloc = "{host}:{port}".format(host=netloc, port=port)
+    if parts.username:
+        netloc = "{auth}@{netloc}".format(auth=parts.netloc.rsplit("@", 1)[0], netloc=netloc)
+    path = parts.path.rstrip("/") or ""
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+
+def url_host(url):
+    """
+    url_host: return the lowercase host name of a URL ("" if it can't be parsed)
+    """
+    try:
+        return (urlsplit(url.strip()).hostname or "").lower()
+    except ValueError:
+        return ""
+
+
+class ResourceIndex(object):
+    """
+    Index of CKAN Resources
+
+    Each distinct normalized URL is one entry; entries record every (package, resource) referencing that URL.
+
+    Attributes
+    ----------
+    entries: dict
+        normalized URL -> {'url': first URL seen, 'host': host, 'resources': [resource dicts with 'package_id' added]}
+    by_format: dict
+        lowercase resource format -> set of normalized URLs
+    by_name: dict
+        lowercase resource name -> set of normalized URLs
+    by_host: dict
+        lowercase URL host -> set of normalized URLs
+    query: dict
+        the catalog query the index was built from ({'catalog_api_url': ..., 'params': [...]}, persisted with the index so
+        a saved index is only reused for the same query), or None
+    """
+
+    def __init__(self, query=None):
+        self.query = query
+        self.entries = {}
+        self.by_format = {}
+        self.by_name = {}
+        self.by_host = {}
+        # ids of the resources indexed per normalized URL (not persisted, rebuilt by load):
+        self._resource_ids = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def from_results(cls, results, query=None):
+        """
+        Build an index from dataset_query results - format: [{'id': 'package_id', 'package': 'package_json'},]
+        """
+        index = cls(query=query)
+        for result in results:
+            index.add_package(result['package'])
+        return index
+
+    def add_package(self, package):
+        """
+        Add all Resources of a CKAN package to the index
+        """
+        for resource in package.get('resources', []):
+            self.add_resource(package['id'], resource)
+
+    def add_resource(self, package_id, resource):
+        """
+        Add a single CKAN Resource (belonging to package_id) to the index
+        """
+        url = resource.get('url')
+        if not url:
+            return
+        key = normalize_url(url)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = {'url': url.strip(), 'host': url_host(url), 'resources': []}
+            self.by_host.setdefault(entry['host'], set()).add(key)
+
+        # skip re-adding the same resource (eg. when the index is updated with overlapping query results):
+        resource_ids = self._resource_ids.setdefault(key, set())
+        if resource.get('id') is not None:
+            if resource['id'] in resource_ids:
+                return
+            resource_ids.add(resource['id'])
+        indexed = dict(resource)
+        indexed['package_id'] = package_id
+        entry['resources'].append(indexed)
+        self.by_format.setdefault((resource.get('format') or "").lower(), set()).add(key)
+        self.by_name.setdefault((resource.get('name') or "").lower(), set()).add(key)
+
+    def select(self, formats=None, names=None, hosts=None):
+        """
+        Return the normalized URLs matching all of the given criteria (each a list of values matched case-insensitively,
+        or None to not filter by that key), sorted
+        """
+        selected = None
+        for values, keyed in ((formats, self.by_format), (names, self.by_name), (hosts, self.by_host)):
+            if values is None:
+                continue
+            matched = set()
+            for value in values:
+                matched |= keyed.get(value.lower(), set())
+            selected = matched if selected is None else selected & matched
+        if selected is None:
+            selected = set(self.entries)
+        return sorted(selected)
+
+    def package_ids(self, key):
+        """
+        Return the sorted, distinct package ids referencing a normalized URL
+        """
+        return sorted(set(resource['package_id'] for resource in self.entries[key]['resources']))
+
+    def resources(self, keys):
+        """
+        Return the flat list of indexed resources for the given normalized URLs
+        """
+        return [resource for key in keys for resource in self.entries[key]['resources']]
+
+    def save(self, filename):
+        """
+        Persist the index to a gzipped JSON file (the keyed lookups are rebuilt on load)
+        """
+        with gzip.open(filename, "wt") as f:
+            json.dump({'query': self.query, 'entries': self.entries}, f)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load an index persisted with save()
+        """
+        with gzip.open(filename, "rt") as f:
+            saved = json.load(f)
+        index = cls(query=saved.get('query'))
+        for entry in saved['entries'].values():
+            for resource in entry['resources']:
+                index.add_resource(resource['package_id'], resource)
+        return index
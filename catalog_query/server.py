@@ -0,0 +1,287 @@
+"""
+Long-running local HTTP/JSON service exposing catalog-query Actions ('catalog-query serve')
+
+The service keeps its HTTP connection pool, organization directory and CKAN API response cache warm across requests,
+and queues long-running Actions (eg. resource_cc_check) as background jobs:
+
+    GET  /                                  list available actions
+    GET  /action/<action>?query_params=...  run an Action and return its results as JSON
+    POST /action/<action>                   same, with parameters passed as a JSON object in the request body
+    GET  /jobs/<job_id>                     status (and results, once finished) of a background job
+"""
+import argparse
+import json
+import socketserver
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pandas
+
+from .catalog_query import IOOS_CATALOG_URL, VALID_QUERY_ACTIONS, ActionException, load_action
+from .util import make_session, ResponseCache
+
+# Actions that may run for a long time are queued as background jobs rather than run within the request:
+BACKGROUND_ACTIONS = ['resource_cc_check', 'metadata_fetch', 'resource_url_check']
+
+# Actions that read local files named in their parameters are only available from the command line:
+LOCAL_ACTIONS = ['snapshot_diff']
+SERVICE_ACTIONS = [action for action in VALID_QUERY_ACTIONS if action not in LOCAL_ACTIONS]
+
+# finished (or failed) background jobs are kept, with their results, for JOB_TTL seconds and at most MAX_JOBS of them:
+JOB_TTL = 60 * 60
+MAX_JOBS = 100
+
+# request parameters accepted by the service, mapped to the Action keyword argument they set (same as the CLI):
+ACTION_PARAMS = {
+    'catalog_api_url': 'catalog_api_url',
+    'query_params': 'query',
+    'operator': 'operator',
+    'cc_tests': 'cc_tests',
+}
+
+
+def to_json_result(result):
+    """
+    Convert the return value of Action.run() (list of dicts, DataFrame or tuple of DataFrames) to a JSON-serializable value
+    """
+    if isinstance(result, tuple):
+        return [to_json_result(item) for item in result]
+    if isinstance(result, pandas.DataFrame):
+        return json.loads(result.reset_index(drop=True).to_json(orient='records'))
+    return result
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    HTTP server handling each request in a thread (http.server.ThreadingHTTPServer requires Python 3.7)
+    """
+    daemon_threads = True
+
+
+class CatalogService(object):
+    """
+    Shared state for the service: HTTP session, caches and the background job executor
+
+    Attributes
+    ----------
+    catalog_api_url : str
+        default URL of CKAN API to submit queries to (may be overridden per request with 'catalog_api_url')
+    session: requests.Session
+        HTTP session shared by all Actions run by the service
+    response_cache: ResponseCache
+        CKAN API response cache shared by all Actions run by the service
+    jobs: dict
+        background jobs by job id (finished jobs are evicted after job_ttl seconds, or when more than max_jobs are kept)
+    """
+
+    def __init__(self, catalog_api_url=IOOS_CATALOG_URL, cache_ttl=300, workers=2, pool_size=10, job_ttl=JOB_TTL, max_jobs=MAX_JOBS):
+        self.catalog_api_url = catalog_api_url
+        self.session = make_session(pool_size)
+        self.response_cache = ResponseCache(ttl=cache_ttl)
+        self.job_ttl = job_ttl
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        # finish times of finished jobs, oldest first:
+        self._finished = OrderedDict()
+        self._jobs_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def action_spec(self, params):
+        """
+        Build the Action keyword arguments from request parameters
+        """
+        spec = {
+            'catalog_api_url': self.catalog_api_url,
+            'operator': 'AND',
+            'session': self.session,
+            'response_cache': self.response_cache,
+            'write_results': False,
+            'write_out': False,
+        }
+        for param, value in params.items():
+            if param not in ACTION_PARAMS:
+                raise ActionException("Error: unknown parameter '{param}'.  Valid parameters: {valid}".format(param=param, valid=", ".join(sorted(ACTION_PARAMS))))
+            spec[ACTION_PARAMS[param]] = value
+        return spec
+
+    def run_action(self, action_name, params):
+        """
+        Run the named Action with the request parameters and return its results
+        """
+        Action = load_action(action_name)
+        action = Action(**self.action_spec(params))
+        try:
+            return to_json_result(action.run())
+        finally:
+            action.close()
+
+    def submit_job(self, action_name, params):
+        """
+        Queue the named Action as a background job, return the job record
+        """
+        # validate the parameters before queueing:
+        self.action_spec(params)
+        job_id = uuid.uuid4().hex
+        job = {'id': job_id, 'action': action_name, 'params': params, 'status': 'queued', 'submitted': datetime.utcnow().isoformat()}
+        with self._jobs_lock:
+            self._evict_jobs()
+            self.jobs[job_id] = job
+            self._executor.submit(self._run_job, job)
+            return dict(job)
+
+    def _run_job(self, job):
+        self._update_job(job, status='running', started=datetime.utcnow().isoformat())
+        try:
+            result = self.run_action(job['action'], job['params'])
+            self._update_job(job, status='finished', result=result, finished=datetime.utcnow().isoformat())
+        except Exception as e:
+            traceback.print_exc()
+            self._update_job(job, status='failed', error=str(e), finished=datetime.utcnow().isoformat())
+        with self._jobs_lock:
+            self._finished[job['id']] = time.time()
+
+    def _update_job(self, job, **kwargs):
+        with self._jobs_lock:
+            job.update(kwargs)
+
+    def _evict_jobs(self):
+        """
+        drop finished jobs older than job_ttl, and the oldest ones beyond max_jobs (call with _jobs_lock held)
+        """
+        now = time.time()
+        while self._finished:
+            job_id, finished = next(iter(self._finished.items()))
+            if now - finished <= self.job_ttl and len(self._finished) <= self.max_jobs:
+                break
+            del self._finished[job_id]
+            self.jobs.pop(job_id, None)
+
+    def get_job(self, job_id):
+        with self._jobs_lock:
+            self._evict_jobs()
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+
+class CatalogRequestHandler(BaseHTTPRequestHandler):
+    """
+    Request handler dispatching /action/<action> and /jobs/<job_id> requests to the CatalogService
+    """
+
+    # set on the handler subclass created in make_server():
+    service = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        self.dispatch(url.path, params)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            params = json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+        except ValueError as e:
+            return self.send_json(400, {'error': "Request body is not valid JSON: {}".format(e)})
+        if not isinstance(params, dict):
+            return self.send_json(400, {'error': "Request body must be a JSON object of Action parameters"})
+        self.dispatch(url.path, params)
+
+    def dispatch(self, path, params):
+        parts = [part for part in path.split("/") if part]
+        try:
+            if not parts:
+                return self.send_json(200, {'actions': SERVICE_ACTIONS, 'background_actions': BACKGROUND_ACTIONS})
+
+            if parts[0] == "action" and len(parts) == 2:
+                action_name = parts[1]
+                if action_name not in SERVICE_ACTIONS:
+                    return self.send_json(404, {'error': "Unknown action: {}.  Valid query actions: {}".format(action_name, ", ".join(SERVICE_ACTIONS))})
+                if action_name in BACKGROUND_ACTIONS:
+                    job = self.service.submit_job(action_name, params)
+                    return self.send_json(202, job, headers={'Location': "/jobs/{}".format(job['id'])})
+                result = self.service.run_action(action_name, params)
+                return self.send_json(200, {'action': action_name, 'params': params, 'result': result})
+
+            if parts[0] == "jobs" and len(parts) == 2:
+                job = self.service.get_job(parts[1])
+                if job is None:
+                    return self.send_json(404, {'error': "Unknown job: {}".format(parts[1])})
+                return self.send_json(200, job)
+
+            return self.send_json(404, {'error': "Not found: {}".format(path)})
+        except ActionException as e:
+            return self.send_json(400, {'error': str(e)})
+        except Exception as e:
+            traceback.print_exc()
+            return self.send_json(500, {'error': str(e)})
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def make_server(service, host="127.0.0.1", port=8080):
+    """
+    Create the HTTP server for a CatalogService
+    """
+    handler = type('BoundCatalogRequestHandler', (CatalogRequestHandler,), {'service': service})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    """
+    Command line interface for 'catalog-query serve'
+    """
+    parser = argparse.ArgumentParser(prog='catalog-query serve', description='Run catalog-query Actions as a local HTTP/JSON service.')
+
+    parser.add_argument('-c', '--catalog_api_url', type=str, default=IOOS_CATALOG_URL,
+                        help='Default URL of CKAN Catalog to query (may be overridden per request).  Default: {cat_url}'.format(cat_url=IOOS_CATALOG_URL))
+
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Interface to listen on.  Default: 127.0.0.1')
+
+    parser.add_argument('-p', '--port', type=int, default=8080,
+                        help='Port to listen on.  Default: 8080')
+
+    parser.add_argument('--cache_ttl', type=int, default=300,
+                        help='Number of seconds to cache CKAN API responses.  Default: 300')
+
+    parser.add_argument('--jobs', type=int, default=2,
+                        help='Number of background jobs (eg. resource_cc_check) to run concurrently.  Default: 2')
+
+    parser.add_argument('--job_ttl', type=int, default=JOB_TTL,
+                        help='Number of seconds finished background jobs (and their results) are kept.  Default: {}'.format(JOB_TTL))
+
+    parser.add_argument('--max_jobs', type=int, default=MAX_JOBS,
+                        help='Maximum number of finished background jobs kept.  Default: {}'.format(MAX_JOBS))
+
+    args = parser.parse_args(argv)
+
+    service = CatalogService(catalog_api_url=args.catalog_api_url, cache_ttl=args.cache_ttl, workers=args.jobs, job_ttl=args.job_ttl, max_jobs=args.max_jobs)
+    server = make_server(service, host=args.host, port=args.port)
+    print("Serving catalog-query on http://{host}:{port}/".format(host=args.host, port=args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
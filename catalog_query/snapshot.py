@@ -0,0 +1,185 @@
+"""
+Arrow IPC snapshots of flattened catalog records (datasets and resources), written by Actions with --arrow and opened
+zero-copy via memory mapping, so that many reader processes share the OS page cache rather than each parsing a CSV:
+
+    from catalog_query.snapshot import open_snapshot
+    snapshot = open_snapshot("nanoos")     # nanoos.datasets.arrow, nanoos.resources.arrow
+    datasets = snapshot['datasets']        # pyarrow.Table; .to_pandas() for a (copied) DataFrame
+
+Requires pyarrow (optional dependency: pip install pyarrow).
+"""
+import json
+import os
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+from .catalog_query import ActionException
+from .resource_index import url_host
+
+# snapshot tables, by file name suffix:
+TABLES = ['datasets', 'resources']
+
+# maximum number of records per record batch written, and converted to Python dicts at once when read:
+BATCH_SIZE = 10000
+
+
+def require_pyarrow():
+    if pyarrow is None:
+        raise ActionException("Error: Arrow snapshots require the 'pyarrow' package, which is not installed (pip install pyarrow).")
+
+
+def dataset_schema():
+    require_pyarrow()
+    return pyarrow.schema([
+        ('id', pyarrow.string()),
+        ('name', pyarrow.string()),
+        ('dataset_url', pyarrow.string()),
+        ('title', pyarrow.string()),
+        ('organization', pyarrow.string()),
+        ('harvest_object_url', pyarrow.string()),
+        ('waf_location', pyarrow.string()),
+        ('type', pyarrow.string()),
+        ('num_resources', pyarrow.int32()),
+        ('num_tags', pyarrow.int32()),
+        ('formats', pyarrow.list_(pyarrow.string())),
+        # [west, south, east, north], null if the dataset has no (parsable) 'spatial' extra:
+        ('bbox', pyarrow.list_(pyarrow.float64())),
+    ])
+
+
+def resource_schema():
+    require_pyarrow()
+    return pyarrow.schema([
+        ('package_id', pyarrow.string()),
+        ('id', pyarrow.string()),
+        ('name', pyarrow.string()),
+        ('format', pyarrow.string()),
+        ('url', pyarrow.string()),
+        ('host', pyarrow.string()),
+    ])
+
+
+def parse_bbox(spatial):
+    """
+    parse a GeoJSON geometry string (a CKAN 'spatial' extra) into its bounding box [west, south, east, north], or None
+    """
+    try:
+        coordinates = json.loads(spatial)['coordinates']
+    except (ValueError, TypeError, KeyError):
+        return None
+
+    points = []
+
+    def collect(value):
+        # a point is a list of numbers, anything other than (nested) lists of points makes the geometry unusable:
+        if not isinstance(value, (list, tuple)):
+            raise ValueError("not a coordinate list: {!r}".format(value))
+        if value and isinstance(value[0], (int, float)):
+            points.append(value)
+        else:
+            for item in value:
+                collect(item)
+
+    # (points with fewer than two or non-numeric coordinates make the geometry unusable:)
+    try:
+        collect(coordinates)
+        xs, ys = [float(point[0]) for point in points], [float(point[1]) for point in points]
+    except (TypeError, ValueError, IndexError):
+        return None
+    if not points:
+        return None
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def dataset_record(dataset, package):
+    """
+    typed dataset snapshot record, from a flattened dataset (ActionBase.parse_dataset) and its CKAN package
+    """
+    record = dict(dataset)
+    # the flattened 'title' is quoted for CSV output and 'formats' joined into a string, take both from the package instead:
+    record['title'] = package['title']
+    record['formats'] = [resource['format'] for resource in package['resources']]
+    record['bbox'] = parse_bbox(dataset['bbox']) if dataset['bbox'] else None
+    return record
+
+
+def resource_records(package):
+    """
+    resource snapshot records of a CKAN package
+    """
+    return [{
+        'package_id': package['id'],
+        'id': resource.get('id'),
+        'name': resource.get('name'),
+        'format': resource.get('format'),
+        'url': resource.get('url'),
+        'host': url_host(resource['url']) if resource.get('url') else None,
+    } for resource in package.get('resources', [])]
+
+
+def write_table(records, schema, filename):
+    """
+    write records (list of dicts) as an Arrow IPC file (uncompressed, so it can be memory-mapped without decoding).
+    The file is written under a temporary name and renamed into place, so readers that have the previous version mapped
+    keep a consistent view of it.
+    """
+    require_pyarrow()
+    table = pyarrow.table(dict((name, [record.get(name) for record in records]) for name in schema.names), schema=schema)
+    tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    with pyarrow.OSFile(tmp_filename, "wb") as sink:
+        with pyarrow.ipc.new_file(sink, schema) as writer:
+            writer.write_table(table, max_chunksize=BATCH_SIZE)
+    os.replace(tmp_filename, filename)
+
+
+def write_snapshot(prefix, datasets, packages):
+    """
+    write the dataset and resource tables of a snapshot ('<prefix>.datasets.arrow', '<prefix>.resources.arrow') from
+    flattened datasets and their CKAN packages (in the same order); return the paths written
+    """
+    require_pyarrow()
+    paths = snapshot_paths(prefix)
+    write_table([dataset_record(dataset, package) for dataset, package in zip(datasets, packages)], dataset_schema(), paths['datasets'])
+    write_table([record for package in packages for record in resource_records(package)], resource_schema(), paths['resources'])
+    return paths
+
+
+def snapshot_paths(prefix):
+    return dict((table, "{prefix}.{table}.arrow".format(prefix=prefix, table=table)) for table in TABLES)
+
+
+def open_table(filename):
+    """
+    open an Arrow IPC file as a pyarrow.Table backed by a memory map of the file (zero-copy)
+    """
+    require_pyarrow()
+    return pyarrow.ipc.open_file(pyarrow.memory_map(filename, "r")).read_all()
+
+
+def record_reader(filename):
+    """
+    open an Arrow IPC file through a memory map, return its column names and an iterator of its records (dicts),
+    converted at most BATCH_SIZE records at a time (also for files written as a single record batch)
+    """
+    require_pyarrow()
+    reader = pyarrow.ipc.open_file(pyarrow.memory_map(filename, "r"))
+
+    def records():
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            for offset in range(0, batch.num_rows, BATCH_SIZE):
+                for record in batch.slice(offset, BATCH_SIZE).to_pylist():
+                    yield record
+
+    return reader.schema.names, records()
+
+
+def open_snapshot(prefix):
+    """
+    open the tables of a snapshot written with write_snapshot, return a dict of pyarrow.Table by table name
+    """
+    return dict((table, open_table(path)) for table, path in snapshot_paths(prefix).items())
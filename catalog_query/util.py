@@ -5,41 +5,137 @@ import os
 import errno
 import logging
 import json
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 
 from .catalog_query import ActionException
+from .organizations import get_directory
+from . import logs
 
 
-def obtain_owner_org(api_url, org_name, logger=None):
+class NullOutput(object):
     """
-    obtain_owner_org: return org info from the CKAN API via query by Org Name (self.query_org)
-    obtain the organization id:
-    https://data.ioos.us/api/3/action/organization_list?q=
+    File-like object that discards everything written to it (stands in for an Action's 'out' file when not requested)
     """
-    action = "organization_list"
-    payload = {'q': org_name, 'all_fields': 'true'}
-    url = ("/").join([api_url, "action", action])
-    if logger:
-        logger.info("Executing {action}.  URL: {url}. Parameters {params}".format(action=action, url=url, params=payload))
-    r = requests.post(url=url, json=payload)
 
-    result = json.loads(r.text)
-    print(json.dumps(result, indent=4, sort_keys=True))
+    def write(self, s):
+        return len(s)
 
-    # the step to loop through the 'result' array isn't really necessary since we expect the org name
-    # to match what was passed in the query, but it is safer than assuming it will (API may return multiple)
-    for org in result['result']:
-        # could also use org['title'] it seems
-        if org['display_name'] == org_name:
-            org_result = org
+    def close(self):
+        pass
 
-    # check to make sure a valid Org name was passed:
-    try:
-        org_result
-    except NameError:
-        raise ActionException("Error: no Organization matching {org} exists in the Catalog.  Please try again (query is case sensitive).".format(org=org_name))
 
-    print("Organization id: {id}".format(id=org_result['id']))
+def make_session(pool_size=10):
+    """
+    make_session: create a requests.Session with a connection pool sized for 'pool_size' concurrent requests
+    (per host), so that repeated/concurrent CKAN API queries reuse open connections
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class ResponseCache(object):
+    """
+    Thread-safe, TTL-bounded in-memory cache of CKAN API responses, keyed by request URL plus payload
+
+    Attributes
+    ----------
+    ttl: int
+        number of seconds a cached response is considered valid
+    max_entries: int
+        maximum number of responses to hold; the oldest entries are evicted first
+    """
+
+    def __init__(self, ttl=300, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url, payload):
+        return (url, json.dumps(payload, sort_keys=True))
+
+    def get(self, url, payload):
+        key = self.key(url, payload)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                return None
+            return entry[1]
+
+    def put(self, url, payload, result):
+        key = self.key(url, payload)
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                oldest = min(self._entries, key=lambda k: self._entries[k][0])
+                del self._entries[oldest]
+            self._entries[key] = (time.time(), result)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class HostLimiter(object):
+    """
+    Per-host concurrency caps: a BoundedSemaphore of 'per_host' slots for each host, created on first use
+
+    Usage: with host_limiter.semaphore(host): ...
+    """
+
+    def __init__(self, per_host=4):
+        self.per_host = per_host
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self._semaphores[host]
+
+
+class CircuitBreaker(object):
+    """
+    Per-host circuit breaker: a host's circuit opens after 'max_failures' consecutive failures, and callers
+    should skip further requests to it (a success resets the count)
+    """
+
+    def __init__(self, max_failures=3):
+        self.max_failures = max_failures
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def is_open(self, host):
+        with self._lock:
+            return self._failures.get(host, 0) >= self.max_failures
+
+    def record_success(self, host):
+        with self._lock:
+            self._failures[host] = 0
+
+    def record_failure(self, host):
+        with self._lock:
+            self._failures[host] = self._failures.get(host, 0) + 1
+
+
+def obtain_owner_org(api_url, org_name, logger=None):
+    """
+    obtain_owner_org: return org info (id, name, display_name, title) by Org Name (case-insensitive) from the catalog's
+    organization directory, which loads the organization list once and falls back to organization_show:
+    https://data.ioos.us/api/3/action/organization_list?all_fields=true
+    """
+    org_result = get_directory(api_url).resolve(org_name)
+    logs.event(logger or logging.getLogger(__name__), logs.INFO, "organization", name=org_name, id=org_result['id'])
     return org_result
 
 
@@ -53,25 +149,22 @@ def package_search(api_url, org_id=None, params=None, start_index=0, rows=100, l
     if org_id is not None:
         if params is not None:
             payload = {'q': "owner_org:{id}+{params}".format(id=org_id, params="+".join(params)), 'start': start_index, 'rows': rows}
-            print(payload)
         else:
             payload = {'q': "owner_org:{id}".format(id=org_id), 'start': start_index, 'rows': rows}
-            print(payload)
     else:
         if params is not None:
             payload = {'q': "{params}".format(params=" ".join(params)), 'start': start_index, 'rows': rows}
-            print(payload)
         else:
             payload = {'start': start_index, 'rows': rows}
-            print(payload)
     url = ("/").join([api_url, "action", action])
-    if logger:
-        logger.info("Executing {action}.  URL: {url}. Parameters {params}".format(action=action, url=url, params=payload))
+    logger = logger or logging.getLogger(__name__)
+    logs.event(logger, logs.DEBUG, action, url=url, params=payload)
     #r = requests.get(url=url, headers = {'content-type': 'application/json'}, params=payload)
     #r = requests.post(url=url, headers = {'content-type': 'application/json'}, data=json.dumps(payload))
     r = requests.post(url=url, headers = {'content-type': 'application/json'}, json=payload)
-    print(json.dumps(payload))
-    print(r.text)
+    # the full response is logged at TRACE level only (decoding it is skipped otherwise):
+    if logger.isEnabledFor(logs.TRACE):
+        logs.event(logger, logs.TRACE, "package_search_result", url=url, params=payload, response=r.text)
     # either works:
     #result = json.loads(r.text)
     result = r.json()
@@ -94,7 +187,7 @@ def dataset_query(api_url, org_id=None, params=None, rows=100, logger=None, out=
         # obtain the total result count to iterate if necessary:
         result_count = package_results['result']['count']
         if count == 0:
-            print("result_count: " + str(result_count))
+            logs.event(logger or logging.getLogger(__name__), logs.INFO, "result_count", count=result_count)
 
         # here we just append to dataset_results a nested dict with package['id'] and package JSON string
         for package in package_results['result']['results']:
@@ -0,0 +1,184 @@
+"""
+Durable work queue for sharding Compliance Checker sweeps across processes and hosts, backed by a SQLite file
+
+The resource_cc_check Action (with -wq|--work_queue) enqueues one (url, test) item per check; any number of
+'catalog-query worker' processes claim items under a lease, run the check and write the result back; 'catalog-query merge'
+then writes the usual results and errors CSVs.  A claimed item whose lease expires before its worker reports back (eg.
+the worker was killed) becomes claimable again, up to 'max_attempts' claims.
+
+At most 'per_host' checks of the same host run concurrently across all workers: claiming an item leases one of its
+host's 'per_host' slots, and the slot becomes claimable again 'host_pause' seconds after the check completes (as the
+serial resource_cc_check run pauses between URLs), or when the item's lease expires.
+
+The queue file may live on storage shared between hosts, provided the filesystem supports POSIX file locking.
+"""
+import json
+import sqlite3
+import time
+
+from .resource_index import url_host
+
+# item statuses:
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL,
+    test TEXT NOT NULL,
+    host TEXT,
+    package_ids TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    slot INTEGER,
+    result TEXT,
+    failure TEXT,
+    UNIQUE (url, test)
+);
+CREATE INDEX IF NOT EXISTS items_status ON items (status, lease_expires);
+CREATE TABLE IF NOT EXISTS hosts (
+    host TEXT NOT NULL,
+    slot INTEGER NOT NULL,
+    busy_until REAL,
+    PRIMARY KEY (host, slot)
+);
+"""
+
+# default number of seconds a host slot is left alone after one of its checks completes:
+HOST_PAUSE = 2
+
+# default number of concurrent checks of the same host (across all workers):
+PER_HOST = 1
+
+
+class WorkQueue(object):
+    """
+    SQLite-backed queue of (url, test) Compliance Checker work items
+
+    Attributes
+    ----------
+    filename: str
+        path to the SQLite queue file (created if not existing)
+    max_attempts: int
+        number of times an item may be claimed before it is marked failed with reason 'lease_expired'
+    host_pause: float
+        number of seconds a host slot is left alone after one of its checks completes
+    per_host: int
+        maximum number of items of the same host leased at once (by this and other workers)
+    """
+
+    def __init__(self, filename, max_attempts=3, timeout=60, host_pause=HOST_PAUSE, per_host=PER_HOST):
+        self.filename = filename
+        self.max_attempts = max_attempts
+        self.host_pause = host_pause
+        self.per_host = max(1, per_host)
+        # isolation_level=None: transactions are managed explicitly (BEGIN IMMEDIATE takes the write lock up front):
+        self.conn = sqlite3.connect(filename, timeout=timeout, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def enqueue(self, items):
+        """
+        add (url, test, package_ids) work items; for a (url, test) already in the queue, the package ids are merged into the
+        existing item's.  Return the number of items added.
+        """
+        added = 0
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for url, test, package_ids in items:
+                cursor = self.conn.execute("INSERT OR IGNORE INTO items (url, test, host, package_ids) VALUES (?, ?, ?, ?)", (url, test, url_host(url), package_ids))
+                if cursor.rowcount == 1:
+                    added += 1
+                    continue
+                existing = self.conn.execute("SELECT package_ids FROM items WHERE url = ? AND test = ?", (url, test)).fetchone()['package_ids']
+                merged = sorted(set(filter(None, (existing or "").split(","))) | set(filter(None, (package_ids or "").split(","))))
+                if ",".join(merged) != existing:
+                    self.conn.execute("UPDATE items SET package_ids = ? WHERE url = ? AND test = ?", (",".join(merged), url, test))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return added
+
+    def claim(self, worker, lease_seconds):
+        """
+        claim the next available item (whose host has fewer than 'per_host' slots busy with, or pausing after, other
+        checks) for 'worker' for 'lease_seconds', return it as a dict (None if no item is available)
+        """
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            # items whose lease expired after their last allowed attempt are given up on:
+            self.conn.execute("UPDATE items SET status = ?, failure = ? WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                              (FAILED, json.dumps({'error_msg': "Lease expired after {} attempts".format(self.max_attempts), 'reason': 'lease_expired'}), LEASED, now, self.max_attempts))
+            row = self.conn.execute("SELECT * FROM items "
+                                    "WHERE (status = ? OR (status = ? AND lease_expires < ?)) "
+                                    "AND (SELECT COUNT(*) FROM hosts WHERE hosts.host = items.host AND hosts.busy_until >= ?) < ? "
+                                    "ORDER BY id LIMIT 1",
+                                    (PENDING, LEASED, now, now, self.per_host)).fetchone()
+            if row is not None:
+                # reuse a free slot of the host, or add one:
+                slot = self.conn.execute("SELECT slot FROM hosts WHERE host = ? AND busy_until < ? ORDER BY slot LIMIT 1", (row['host'], now)).fetchone()
+                if slot is not None:
+                    slot = slot['slot']
+                else:
+                    slot = self.conn.execute("SELECT COALESCE(MAX(slot) + 1, 0) FROM hosts WHERE host = ?", (row['host'],)).fetchone()[0]
+                self.conn.execute("UPDATE items SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1, slot = ? WHERE id = ?",
+                                  (LEASED, worker, now + lease_seconds, slot, row['id']))
+                self.conn.execute("INSERT OR REPLACE INTO hosts (host, slot, busy_until) VALUES (?, ?, ?)", (row['host'], slot, now + lease_seconds))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return dict(row) if row is not None else None
+
+    def complete(self, item_id, worker, result=None, failure=None):
+        """
+        record the result (list of result column values) or failure (dict of failure column values) of a claimed item;
+        ignored (returns False) if the worker's lease was lost to another worker in the meantime
+        """
+        status = DONE if result is not None else FAILED
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = self.conn.execute("UPDATE items SET status = ?, result = ?, failure = ?, lease_expires = NULL WHERE id = ? AND status = ? AND worker = ?",
+                                       (status, json.dumps(result) if result is not None else None, json.dumps(failure) if failure is not None else None, item_id, LEASED, worker))
+            completed = cursor.rowcount == 1
+            if completed:
+                # release the item's host slot after a pause:
+                item = self.conn.execute("SELECT host, slot FROM items WHERE id = ?", (item_id,)).fetchone()
+                self.conn.execute("UPDATE hosts SET busy_until = ? WHERE host = ? AND slot = ?", (time.time() + self.host_pause, item['host'], item['slot']))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return completed
+
+    def counts(self):
+        """
+        return the number of items by status
+        """
+        return dict((row['status'], row['n']) for row in self.conn.execute("SELECT status, COUNT(*) AS n FROM items GROUP BY status"))
+
+    def remaining(self):
+        """
+        return the number of items not yet done or failed
+        """
+        return self.conn.execute("SELECT COUNT(*) FROM items WHERE status IN (?, ?)", (PENDING, LEASED)).fetchone()[0]
+
+    def finished(self):
+        """
+        iterate the done and failed items, as dicts with 'result' and 'failure' decoded
+        """
+        for row in self.conn.execute("SELECT * FROM items WHERE status IN (?, ?) ORDER BY id", (DONE, FAILED)):
+            item = dict(row)
+            item['result'] = json.loads(item['result']) if item['result'] else None
+            item['failure'] = json.loads(item['failure']) if item['failure'] else None
+            yield item
@@ -0,0 +1,148 @@
+"""
+'catalog-query worker' and 'catalog-query merge' subcommands: run Compliance Checker work items from a work queue
+enqueued by the resource_cc_check Action (-wq|--work_queue), and merge the results into the usual CSV outputs
+"""
+import argparse
+import logging
+import os
+import socket
+import time
+import uuid
+
+from .action.resource_cc_check import run_cc_check, empty_results, summarize_results, write_results, CC_TIMEOUT, HOST_FAILURE_LIMIT, FAILURE_COLUMNS
+from .util import CircuitBreaker
+from .work_queue import WorkQueue, HOST_PAUSE, PER_HOST
+from . import logs
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker(queue, worker_id, cc_timeout, host_failure_limit, poll_interval=HOST_PAUSE, exit_when_empty=True):
+    """
+    claim and run work items until the queue has none left (or forever, if exit_when_empty is False); return the number run
+    """
+    # each worker keeps its own per-host circuit breaker:
+    breaker = CircuitBreaker(host_failure_limit)
+    # the lease must outlast the check deadline (plus a margin for claiming and reporting back):
+    lease_seconds = cc_timeout + 60
+
+    count = 0
+    while True:
+        item = queue.claim(worker_id, lease_seconds)
+        if item is None:
+            if exit_when_empty and queue.remaining() == 0:
+                break
+            # remaining items are leased by other workers (they become claimable again if those workers die), or their hosts
+            #   are busy with (or pausing after) other workers' checks:
+            time.sleep(poll_interval)
+            continue
+
+        logs.event(logger, logs.DEBUG, "checking_url", sample=True, worker=worker_id, url=item['url'], test=item['test'], attempt=item['attempts'] + 1)
+        result, failure = run_cc_check(item['url'], item['test'], timeout=cc_timeout, breaker=breaker)
+        if failure is not None:
+            failure = dict(zip(FAILURE_COLUMNS, failure))
+        if not queue.complete(item['id'], worker_id, result=result, failure=failure):
+            logs.event(logger, logs.WARNING, "lease_lost", worker=worker_id, id=item['id'], url=item['url'], test=item['test'])
+        count += 1
+
+    return count
+
+
+def merge(queue, results_filename, errors_filename):
+    """
+    write the results and failures of the finished work items to the results and errors CSV files
+    """
+    check_results_df, failures_df = empty_results()
+    package_ids = {}
+    for item in queue.finished():
+        package_ids[item['url']] = item['package_ids']
+        if item['result'] is not None:
+            result = item['result']
+            check_results_df.loc[result[0] + result[1]] = result
+        else:
+            failure = item['failure']
+            failures_df.loc[item['url'] + item['test']] = [item['url'], item['test'], failure.get('cc_command', ""), failure['error_msg'], failure['reason']]
+
+    check_results_df, failures_df = summarize_results(check_results_df, failures_df, package_ids)
+    write_results(check_results_df, failures_df, results_filename, errors_filename)
+    return check_results_df, failures_df
+
+
+def worker_main(argv=None):
+    """
+    Command line interface for 'catalog-query worker'
+    """
+    parser = argparse.ArgumentParser(prog='catalog-query worker', description='Run Compliance Checker work items from a work queue created by the resource_cc_check Action (-wq|--work_queue).')
+
+    parser.add_argument('-wq', '--work_queue', type=str, required=True,
+                        help='Path to the work queue (SQLite file).')
+
+    parser.add_argument('--worker_id', type=str, required=False,
+                        help='Name of this worker, recorded with the items it claims.  Default: <hostname>-<pid>-<random>')
+
+    parser.add_argument('--cc_timeout', type=int, default=CC_TIMEOUT,
+                        help='Deadline (in seconds) for each Compliance Checker test.  Default: {}'.format(CC_TIMEOUT))
+
+    parser.add_argument('--host_failure_limit', type=int, default=HOST_FAILURE_LIMIT,
+                        help='Number of consecutive failed or timed out checks after which this worker skips remaining checks of the same host.  Default: {}'.format(HOST_FAILURE_LIMIT))
+
+    parser.add_argument('--per_host', type=int, default=PER_HOST,
+                        help='Maximum number of concurrent checks of the same host, across all workers (use the same value for all workers of a queue).  Default: {}'.format(PER_HOST))
+
+    parser.add_argument('--poll_interval', type=float, default=HOST_PAUSE,
+                        help='Seconds to wait between claim attempts while no item can be claimed (the remaining items are leased by other workers, or their hosts are busy).  Default: {}'.format(HOST_PAUSE))
+
+    parser.add_argument('--wait', action='store_true',
+                        help='Keep polling for new items when the queue is empty, rather than exiting.')
+
+    parser.add_argument('-v', '--log_level', type=str, default=logs.DEFAULT_LEVEL, choices=list(logs.LEVELS),
+                        help='Log level: \'info\' logs summary lines only, \'debug\' each check, \'trace\' full request/response detail.  Default: {}'.format(logs.DEFAULT_LEVEL))
+
+    parser.add_argument('--log_sample', type=int, default=1,
+                        help='Log only 1 in N of each per-item (eg. per-check) event.  Default: 1 (all)')
+
+    args = parser.parse_args(argv)
+    logs.configure(level=args.log_level, sample_rate=args.log_sample)
+
+    if not os.path.exists(args.work_queue):
+        raise SystemExit("Error: work queue {queue} does not exist.".format(queue=args.work_queue))
+
+    worker_id = args.worker_id or "{host}-{pid}-{rand}".format(host=socket.gethostname(), pid=os.getpid(), rand=uuid.uuid4().hex[:6])
+    queue = WorkQueue(args.work_queue, per_host=args.per_host)
+    try:
+        count = run_worker(queue, worker_id, args.cc_timeout, args.host_failure_limit, poll_interval=args.poll_interval, exit_when_empty=not args.wait)
+    finally:
+        queue.close()
+    logger.info("Worker {worker} finished: ran {count} checks".format(worker=worker_id, count=count))
+
+
+def merge_main(argv=None):
+    """
+    Command line interface for 'catalog-query merge'
+    """
+    parser = argparse.ArgumentParser(prog='catalog-query merge', description='Merge the finished items of a Compliance Checker work queue into results and errors CSV files.')
+
+    parser.add_argument('-wq', '--work_queue', type=str, required=True,
+                        help='Path to the work queue (SQLite file).')
+
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='Results output filename.')
+
+    parser.add_argument('-e', '--error_output', type=str, required=True,
+                        help='Error output filename.')
+
+    args = parser.parse_args(argv)
+    # (summary lines, eg. the output files written, are logged to the console:)
+    logs.configure()
+
+    if not os.path.exists(args.work_queue):
+        raise SystemExit("Error: work queue {queue} does not exist.".format(queue=args.work_queue))
+
+    queue = WorkQueue(args.work_queue)
+    try:
+        remaining = queue.remaining()
+        if remaining:
+            logger.warning("{remaining} work items are not finished yet; merging the finished items only.".format(remaining=remaining))
+        merge(queue, args.output, args.error_output)
+    finally:
+        queue.close()
@@ -39,4 +39,9 @@ kwargs = {
 
 kwargs['install_requires'] = reqs
 
+# optional Arrow IPC snapshots (--arrow, snapshot_diff of .arrow files):
+kwargs['extras_require'] = {
+    'arrow': ['pyarrow'],
+}
+
 setup(**kwargs)
@@ -0,0 +1,48 @@
+from catalog_query.resource_index import ResourceIndex, normalize_url, url_host
+
+BAD_URLS = ['http://h:99999/', 'http://host:abc/x', 'http://[::1/x']
+
+
+def test_normalize_url():
+    assert normalize_url(" HTTP://Example.org:80/dodsC/x/?b=2&a=1#frag ") == "http://example.org/dodsC/x?a=1&b=2"
+    assert normalize_url("https://example.org:8443/x") == "https://example.org:8443/x"
+
+
+def test_unparsable_urls():
+    for url in BAD_URLS:
+        assert normalize_url(" {} ".format(url)) == url
+    assert url_host('http://h:99999/') == "h"
+    assert url_host('http://[::1/x') == ""
+
+
+def test_index_with_unparsable_urls():
+    package = {'id': 'p1', 'resources': [{'id': 'r{}'.format(i), 'url': url, 'format': 'OPeNDAP'} for i, url in enumerate(BAD_URLS)]}
+    package['resources'].append({'id': 'ok', 'url': 'http://example.org/x', 'format': 'OPeNDAP'})
+    index = ResourceIndex.from_results([{'id': 'p1', 'package': package}])
+    assert len(index) == len(BAD_URLS) + 1
+    assert sorted(index.select(formats=['opendap'])) == sorted(BAD_URLS + ['http://example.org/x'])
+
+
+def test_duplicate_resources(tmp_path):
+    resource = {'id': 'r1', 'url': 'http://example.org/x/', 'format': 'WMS'}
+    index = ResourceIndex()
+    index.add_resource('p1', resource)
+    index.add_resource('p1', resource)
+    index.add_resource('p2', {'id': 'r2', 'url': 'http://EXAMPLE.org/x', 'format': 'WMS'})
+    assert index.package_ids('http://example.org/x') == ['p1', 'p2']
+    assert len(index.resources(['http://example.org/x'])) == 2
+
+    filename = str(tmp_path / "index.json.gz")
+    index.save(filename)
+    loaded = ResourceIndex.load(filename)
+    assert loaded.query is None
+    assert loaded.package_ids('http://example.org/x') == ['p1', 'p2']
+    assert loaded.select(formats=['wms']) == ['http://example.org/x']
+
+
+def test_saved_query(tmp_path):
+    query = {'catalog_api_url': 'https://data.ioos.us/api/3', 'params': ['name:NANOOS', 'res_format:WMS']}
+    package = {'id': 'p1', 'resources': [{'id': 'r1', 'url': 'http://example.org/x', 'format': 'WMS'}]}
+    filename = str(tmp_path / "index.json.gz")
+    ResourceIndex.from_results([{'id': 'p1', 'package': package}], query=query).save(filename)
+    assert ResourceIndex.load(filename).query == query
@@ -0,0 +1,26 @@
+import pytest
+
+from catalog_query.snapshot import parse_bbox
+
+
+def test_parse_bbox():
+    assert parse_bbox('{"type": "Point", "coordinates": [-124.5, 46.2]}') == [-124.5, 46.2, -124.5, 46.2]
+    polygon = '{"type": "Polygon", "coordinates": [[[-125, 42], [-123, 42], [-123, 47.5], [-125, 47.5], [-125, 42]]]}'
+    assert parse_bbox(polygon) == [-125.0, 42.0, -123.0, 47.5]
+
+
+@pytest.mark.parametrize("spatial", [
+    '{"coordinates": "abc"}',
+    '{"coordinates": [["1", "2"]]}',
+    '{"coordinates": [[1, "a"]]}',
+    '{"coordinates": [1]}',
+    '{"coordinates": [[1], [2]]}',
+    '{"coordinates": [[[1, 2]], 3]}',
+    '{"coordinates": {"x": 1}}',
+    '{"coordinates": []}',
+    '{"coordinates": null}',
+    '{"type": "Point"}',
+    'not json',
+])
+def test_parse_bbox_malformed(spatial):
+    assert parse_bbox(spatial) is None
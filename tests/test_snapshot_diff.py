@@ -0,0 +1,52 @@
+import csv
+
+import pytest
+
+from catalog_query.action.snapshot_diff import Action, ADDED, REMOVED, MODIFIED, DUPLICATE
+from catalog_query.catalog_query import ActionException
+
+
+def write_csv(path, rows):
+    with open(str(path), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'title', 'formats'])
+        writer.writerows(rows)
+    return str(path)
+
+
+def make_action(tmp_path, partitions=1):
+    old = write_csv(tmp_path / "old.csv", [['a', 'A', 'WMS'], ['b', 'B', 'WMS'], ['c', 'C', 'WMS'], ['c', 'C2', 'WMS']])
+    new = write_csv(tmp_path / "new.csv", [['a', 'A', 'WMS'], ['b', 'B', 'OPeNDAP'], ['d', 'D', 'WMS'], ['d', 'D', 'WMS']])
+    query = "old:{},new:{},partitions:{}".format(old, new, partitions)
+    return Action(query=query, output=str(tmp_path / "diff.csv"), write_out=False)
+
+
+def test_diff_partition(tmp_path):
+    action = make_action(tmp_path)
+    old_partitions = action.partition(action.query_params['old'], str(tmp_path / "old"))
+    new_partitions = action.partition(action.query_params['new'], str(tmp_path / "new"))
+    changes = list(action.diff_partition(old_partitions[0], new_partitions[0]))
+    assert sorted(changes) == sorted([
+        ('c', DUPLICATE, ['old']),
+        ('b', MODIFIED, ['formats']),
+        ('d', ADDED, []),
+        ('d', DUPLICATE, ['new']),
+        ('c', REMOVED, []),
+    ])
+
+
+def test_run(tmp_path):
+    action = make_action(tmp_path, partitions=4)
+    try:
+        counts = action.run()
+    finally:
+        action.close()
+    assert counts == {ADDED: 1, REMOVED: 1, MODIFIED: 1, DUPLICATE: 2}
+    with open(str(tmp_path / "diff.csv")) as f:
+        assert len(list(csv.reader(f))) == 1 + 5
+
+
+@pytest.mark.parametrize("partitions", ["0", "-1", "100000", "x"])
+def test_invalid_partitions(tmp_path, partitions):
+    with pytest.raises(ActionException):
+        make_action(tmp_path, partitions=partitions)
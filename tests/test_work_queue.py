@@ -0,0 +1,55 @@
+import time
+
+from catalog_query.work_queue import WorkQueue, DONE, FAILED
+
+
+def make_queue(tmp_path, **kwargs):
+    return WorkQueue(str(tmp_path / "queue.sqlite"), host_pause=0, **kwargs)
+
+
+def test_claim_and_complete(tmp_path):
+    queue = make_queue(tmp_path)
+    assert queue.enqueue([('http://a.org/x', 'acdd', 'p1'), ('http://b.org/y', 'acdd', 'p2')]) == 2
+    assert queue.enqueue([('http://a.org/x', 'acdd', 'p3')]) == 0
+
+    item = queue.claim('w1', 60)
+    assert (item['url'], item['package_ids']) == ('http://a.org/x', 'p1,p3')
+    assert queue.complete(item['id'], 'w1', result=['http://a.org/x', 'acdd'])
+    # a worker that lost its lease can't complete the item:
+    other = queue.claim('w1', 60)
+    assert not queue.complete(other['id'], 'w2', failure={'error_msg': 'x', 'reason': 'x'})
+    assert queue.complete(other['id'], 'w1', failure={'error_msg': 'x', 'reason': 'x'})
+    assert queue.claim('w1', 60) is None
+    assert queue.counts() == {DONE: 1, FAILED: 1}
+    assert queue.remaining() == 0
+
+
+def test_per_host_leases(tmp_path):
+    items = [('http://a.org/{}'.format(i), 'acdd', 'p') for i in range(8)] + [('http://b.org/x', 'acdd', 'p')]
+    queue = make_queue(tmp_path, per_host=3)
+    queue.enqueue(items)
+    claimed = [queue.claim('w{}'.format(i), 60) for i in range(5)]
+    # 3 of the 8 items of a.org, then the item of b.org:
+    assert [item['url'] for item in claimed[:4]] == ['http://a.org/0', 'http://a.org/1', 'http://a.org/2', 'http://b.org/x']
+    assert claimed[4] is None
+    # a completed check frees its host slot:
+    queue.complete(claimed[1]['id'], 'w1', result=['http://a.org/1', 'acdd'])
+    assert queue.claim('w5', 60)['url'] == 'http://a.org/3'
+    assert queue.claim('w6', 60) is None
+
+
+def test_lease_expiry(tmp_path):
+    queue = make_queue(tmp_path, max_attempts=2)
+    queue.enqueue([('http://a.org/x', 'acdd', 'p')])
+    first = queue.claim('w1', 0)
+    time.sleep(0.01)
+    # the expired lease (and its host slot) are claimable by another worker:
+    second = queue.claim('w2', 0)
+    assert second['id'] == first['id'] and second['attempts'] == 1
+    assert not queue.complete(first['id'], 'w1', result=['http://a.org/x', 'acdd'])
+    time.sleep(0.01)
+    # after max_attempts expired leases, the item is given up on:
+    assert queue.claim('w3', 60) is None
+    failed = list(queue.finished())
+    assert [item['status'] for item in failed] == [FAILED]
+    assert failed[0]['failure']['reason'] == 'lease_expired'